@@ -0,0 +1,20 @@
+#!/usr/bin/env python2.7
+
+"""
+Script used to build the column store of model data for a range
+of months from command line.
+
+"""
+
+
+import sys
+
+from synthpro.synthpro import main_store
+
+if __name__ == '__main__':
+    
+    try:
+        main_store()
+    except KeyboardInterrupt as err:
+        print err
+        sys.exit()
@@ -107,7 +107,7 @@ def calc_area_avgs(args, modelDat, dx, dy, bmask):
     avgs = []
     
     for k in range(nz):
-        dat = modelDat.data[k]
+        dat = np.ma.masked_invalid(modelDat.data[k])
         dat = np.ma.MaskedArray(dat, mask=(bmask | dat.mask ))
         areas = np.ma.MaskedArray(dx * dy, mask=(bmask | dat.mask))
         avgs.append((dat * areas).sum() / areas.sum()) 
@@ -124,7 +124,7 @@ def calc_vol_integrals(args, modelDat, dx, dy, dz, bmask):
     vints = []
     
     for k in range(nz):
-        dat = modelDat.data[k]
+        dat = np.ma.masked_invalid(modelDat.data[k])
         dat = np.ma.MaskedArray(dat, mask=(bmask | dat.mask ))
         vols = np.ma.MaskedArray(dx * dy * dz[k], mask=(bmask | dat.mask))
         vints.append((dat * vols).sum())
@@ -324,8 +324,8 @@ if __name__ == '__main__':
     
     # Load model data
     printmsg.message(config, 'Loading input data...')
-    modelTemp = model.assoc_model(config, 'model_temp')
-    modelSal = model.assoc_model(config, 'model_sal')
+    modelTemp = model.assoc_model(config, 'model_temp', read_columns=False, ocean_only=False)
+    modelSal = model.assoc_model(config, 'model_sal', read_columns=False, ocean_only=False)
 
     # Load mesh data
     dx = load_var(args.mesh, modelTemp.read_var, dxvar)
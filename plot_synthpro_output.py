@@ -306,16 +306,22 @@ if __name__ == '__main__':
     config = tools.build_file_name(args, config, 'model_sal') 
     printmsg.inputs(config) 
     
-    # Load data objects     
-    printmsg.loading(config)
-    obsDat = profiles.assoc_profiles(config, 'obs_profiles')
-    synthDat = profiles.assoc_profiles(config, 'synth_profiles', read_only=True)
-    modelTemp = model.assoc_model(config, 'model_temp')
-    modelSal = model.assoc_model(config, 'model_sal')
+    # Open each file once for all reads
+    datasets.configure(config)
     
-    # Create plots
-    printmsg.message(config, 'Generating comparison plots...')
-    plot_profile_locations(args, config, obsDat, synthDat, modelTemp)
-    plot_dist2ob_hist(args, config, synthDat)
-    plot_obs_vs_synth(args, config, obsDat, synthDat)
-    plot_example_profiles(args, config, obsDat, synthDat, modelTemp, modelSal)
+    with datasets.session():
+    
+        # Load data objects     
+        printmsg.loading(config)
+        obsDat = profiles.assoc_profiles(config, 'obs_profiles')
+        synthDat = profiles.assoc_profiles(config, 'synth_profiles', read_only=True, 
+                                           preload_data=True)
+        modelTemp = model.assoc_model(config, 'model_temp', read_columns=False, ocean_only=False)
+        modelSal = model.assoc_model(config, 'model_sal', read_columns=False, ocean_only=False)
+        
+        # Create plots
+        printmsg.message(config, 'Generating comparison plots...')
+        plot_profile_locations(args, config, obsDat, synthDat, modelTemp)
+        plot_dist2ob_hist(args, config, synthDat)
+        plot_obs_vs_synth(args, config, obsDat, synthDat)
+        plot_example_profiles(args, config, obsDat, synthDat, modelTemp, modelSal)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python2.7
+
+"""
+Script used to execute SynthPro package for a range of months
+from command line.
+
+"""
+
+
+import sys
+
+from synthpro.synthpro import main_batch
+
+if __name__ == '__main__':
+    
+    try:
+        main_batch()
+    except KeyboardInterrupt as err:
+        print err
+        sys.exit()
+        
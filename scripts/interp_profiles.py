@@ -87,12 +87,17 @@ class Profiles(object):
         self._read_data()
 
     def _read_data(self):
-        """ Read profile data from netcdf file """
-        self._load_temps()
-        self._load_sals()
-        self._load_depths()
-        self._load_lats()
-        self._load_lons()
+        """ Read profile data from netcdf file opened once for all variables """
+        self._ds = Dataset(self.ncf)
+        try:
+            self._load_temps()
+            self._load_sals()
+            self._load_depths()
+            self._load_lats()
+            self._load_lons()
+        finally:
+            self._ds.close()
+            self._ds = None
 
     def save_profiles(self):
         """ Write temperature and salinity profiles to netcdf """
@@ -104,10 +109,7 @@ class Profiles(object):
 
     def _read_var(self, ncvar):
         """ Read data from specified variable """
-        ds = Dataset(self.ncf)
-        dat = ds.variables[ncvar][:]
-        ds.close()
-        return dat   
+        return self._ds.variables[ncvar][:]
 
     def _mask_data(self, dat):
         """ Test for mdi and NaN values and ensure data is masked """
@@ -0,0 +1,122 @@
+"""
+Persistent on-disk cache of observation-to-grid matchups.
+
+"""
+
+import os
+import glob
+import tempfile
+import numpy as np
+
+import tools
+
+
+# Increment if changes to the nearest-neighbour search alter matchups
+CACHE_VERSION = 1
+
+
+class MatchupCache(object):
+    """
+    Class containing methods to store and retrieve the j, i index
+    and distance of the nearest-neighbour model grid-point for
+    each observed location. Entries are keyed by a hash of the model
+    grid and observed locations so that they can be shared by
+    different models on the same grid and reused by repeated runs.
+    The least recently used entries are removed when the total size
+    of the cache exceeds max_mb.
+    
+    """
+    def __init__(self, cache_dir, max_mb=1024.):
+        """ Initialize <MatchupCache> object """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024. * 1024.
+        
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+            
+    def grid_key(self, grid):
+        """ Return key identifying grid coordinates, mask and ij range """
+        if getattr(grid, 'matchup_key', None) is None:
+            grid.load_surface_mask()
+            grid.load_lats()
+            grid.load_lons()
+            ijrange = np.array([grid.imin, grid.imax, grid.jmin, grid.jmax])
+            grid.matchup_key = tools.hash_arrays(
+                np.array([CACHE_VERSION]), ijrange, grid.surface_mask, grid.lats, grid.lons)
+            
+        return grid.matchup_key
+    
+    def key(self, grid, obs_lats, obs_lons):
+        """ Return key identifying matchups between grid and observed locations """
+        obs_key = tools.hash_arrays(obs_lats, obs_lons)
+        
+        return tools.hash_arrays(np.array([self.grid_key(grid), obs_key]))
+    
+    def entry_path(self, key):
+        """ Return path to cache entry """
+        return os.path.join(self.cache_dir, 'matchup_%s.npz' % key)
+    
+    def load(self, key):
+        """ Return j, i, dist for cache entry or None if missing """
+        path = self.entry_path(key)
+        
+        try:
+            entry = np.load(path)
+            j = np.ma.MaskedArray(entry['j'], mask=entry['mask'])
+            i = np.ma.MaskedArray(entry['i'], mask=entry['mask'])
+            dist = entry['dist']
+            entry.close()
+        except (IOError, KeyError, ValueError):
+            return None
+        
+        os.utime(path, None)
+        
+        return j, i, dist
+    
+    def save(self, key, j, i, dist):
+        """ Save j, i, dist as a cache entry and evict old entries """
+        fd, tmpf = tempfile.mkstemp(suffix='.npz', dir=self.cache_dir)
+        
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, j=np.ma.getdata(j), i=np.ma.getdata(i),
+                     mask=np.ma.getmaskarray(j), dist=dist)
+            
+        os.chmod(tmpf, 0o644)
+        os.rename(tmpf, self.entry_path(key))
+        self.evict()
+        
+    def evict(self):
+        """ Remove least recently used entries until cache is within size limit """
+        entries = []
+        
+        for path in glob.glob(os.path.join(self.cache_dir, 'matchup_*.npz')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        
+        for mtime, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            
+            try:
+                tools.rmfile(path)
+            except OSError:
+                pass
+            total -= size
+
+    
+def assoc_cache(config):
+    """
+    Return <MatchupCache> object if enabled in configuration options.
+    
+    """
+    if not config.getboolean('cache', 'use_cache'):
+        return None
+    
+    return MatchupCache(config.get('cache', 'cache_dir'),
+                        max_mb=config.getfloat('cache', 'max_mb'))
@@ -0,0 +1,91 @@
+"""
+Routines to record the progress of an extraction in the synthetic
+profile file so that interrupted runs can be resumed.
+
+"""
+
+import os
+
+import datasets
+import profiles
+
+
+# Global attribute holding the number of leading profiles written
+PROGRESS_ATTR = 'synthpro_profiles_done'
+
+
+class Progress(object):
+    """
+    Class recording the rows of the synthetic profile file that have
+    been written. Rows may be completed in any order, but the progress
+    marker only covers the leading rows that have all been written, so
+    that a resumed run never skips unwritten profiles.
+
+    """
+    def __init__(self, config, ndone=0):
+        """ Initialize <Progress> object for synthetic profile file """
+        self.f = config.get('synth_profiles', 'file_name')
+        self.ndone = ndone
+        self.pending = {}
+
+    def update(self, rows):
+        """ Record rows given as a slice as written and update marker """
+        self.pending[rows.start] = rows.stop
+
+        while self.ndone in self.pending:
+            self.ndone = self.pending.pop(self.ndone)
+
+        mark_done(self.f, self.ndone)
+
+
+def mark_done(f, ndone):
+    """ Write number of leading profiles written to file and flush to disk """
+    with datasets.open_dataset(f, 'r+') as ncf:
+        ncf.setncattr(PROGRESS_ATTR, ndone)
+        ncf.sync()
+
+
+def profiles_done(config):
+    """
+    Return number of leading profiles already written to the synthetic
+    profile file, or zero if the file is missing or unreadable.
+
+    """
+    f = config.get('synth_profiles', 'file_name')
+
+    if not os.path.isfile(f):
+        return 0
+
+    try:
+        with datasets.open_dataset(f) as ncf:
+            ndone = int(getattr(ncf, PROGRESS_ATTR, 0))
+    except (IOError, RuntimeError):
+        return 0
+
+    return ndone
+
+
+def resume_from(args, config):
+    """
+    Return first profile to extract. Runs without --resume start from
+    the first profile. Resumed runs start after the last checkpoint.
+
+    """
+    if not getattr(args, 'resume', False):
+        return 0
+
+    return profiles_done(config)
+
+
+def count_profiles(config):
+    """ Return total number of observed profiles """
+    obsDat = profiles.assoc_profiles(config, 'obs_profiles', preload_data=False)
+
+    return obsDat.count()
+
+
+def is_complete(args, config):
+    """ Return True if a resumed run has no profiles left to extract """
+    ndone = resume_from(args, config)
+
+    return (ndone > 0) and (ndone >= count_profiles(config))
@@ -0,0 +1,105 @@
+"""
+On-disk store of ocean columns of model data that can be
+memory-mapped by <ModelData> objects.
+
+"""
+
+import os
+import tempfile
+import numpy as np
+
+import tools
+
+
+# Increment if changes to the store layout alter stored columns
+STORE_VERSION = 2
+
+
+class ColumnStore(object):
+    """
+    Class containing methods to save the ragged ocean columns of model
+    data as float32 binary files and to memory-map them. Entries are keyed
+    by the model file, variable, mask and ij range, and are rebuilt
+    if the model or mask files change.
+
+    """
+    def __init__(self, store_dir):
+        """ Initialize <ColumnStore> object """
+        self.store_dir = store_dir
+
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def key(self, modelDat):
+        """ Return key identifying model file, variable, mask and ij range """
+        ident = [STORE_VERSION, os.path.abspath(modelDat.f), modelDat.data_var,
+                 os.path.abspath(modelDat.maskf), modelDat.mask_var, modelDat.mask_mdi,
+                 modelDat.imin, modelDat.imax, modelDat.jmin, modelDat.jmax]
+
+        return tools.hash_arrays(np.array([repr(ident)]))
+
+    def stamp(self, modelDat):
+        """ Return sizes and modification times of model and mask files """
+        stats = [os.stat(f) for f in [modelDat.f, modelDat.maskf]]
+
+        return np.array([[stat.st_size, stat.st_mtime] for stat in stats])
+
+    def entry_paths(self, key):
+        """ Return paths to column and index files of store entry """
+        base = os.path.join(self.store_dir, 'columns_%s' % key)
+
+        return base + '.npy', base + '.npz'
+
+    def load(self, modelDat):
+        """ Return memory-mapped <tools.OceanColumns> or None if missing or out of date """
+        colf, indexf = self.entry_paths(self.key(modelDat))
+
+        try:
+            index = np.load(indexf)
+            jinds, iinds, nlev = index['jinds'], index['iinds'], index['nlev']
+            shape, nz, stamp = tuple(index['shape']), int(index['nz']), index['stamp']
+            index.close()
+            values = np.load(colf, mmap_mode='r')
+        except (IOError, KeyError, ValueError):
+            return None
+
+        if not np.array_equal(stamp, self.stamp(modelDat)):
+            return None
+
+        return tools.OceanColumns(values, jinds, iinds, nlev, shape, nz)
+
+    def save(self, modelDat, cols):
+        """
+        Save ocean columns given as <tools.OceanColumns>. The column file
+        is written before the index file so that entries are only used
+        once complete.
+
+        """
+        colf, indexf = self.entry_paths(self.key(modelDat))
+        stamp = self.stamp(modelDat)
+
+        self.write(colf, '.npy', lambda f: np.save(f, cols.values))
+        self.write(indexf, '.npz', lambda f: np.savez(
+            f, jinds=cols.jinds, iinds=cols.iinds, nlev=cols.nlev, nz=cols.nz,
+            shape=np.array(cols.colmap.shape), stamp=stamp))
+
+    def write(self, path, suffix, save):
+        """ Write file using save function and move into place """
+        fd, tmpf = tempfile.mkstemp(suffix=suffix, dir=self.store_dir)
+
+        with os.fdopen(fd, 'wb') as f:
+            save(f)
+
+        os.chmod(tmpf, 0o644)
+        os.rename(tmpf, path)
+
+
+def assoc_store(config):
+    """
+    Return <ColumnStore> object if enabled in configuration options.
+
+    """
+    if not config.getboolean('store', 'use_store'):
+        return None
+
+    return ColumnStore(config.get('store', 'store_dir'))
@@ -0,0 +1,187 @@
+"""
+Shared pool of open netcdf datasets. Access to the pool and to 
+open datasets is serialized by a lock so that files can be read 
+and written from background threads.
+
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+import netCDF4
+from netCDF4 import Dataset
+
+
+class DatasetPool(object):
+    """
+    Reference-counted pool of open <netCDF4.Dataset> objects. Each 
+    file is opened once and the same handle is returned to all users. 
+    Handles are closed when no longer in use unless a session is active, 
+    in which case they remain open until the outermost session ends.
+    
+    """
+    def __init__(self):
+        """ Initialize empty <DatasetPool> """
+        self.handles = {}
+        self.nsessions = 0
+        
+    def key(self, f):
+        """ Return key identifying file """
+        return os.path.abspath(f)
+        
+    def acquire(self, f, mode='r', **kwargs):
+        """ 
+        Return open dataset for file and increment its reference count. 
+        Files opened read-only are reopened for writing if mode='r+'.
+        Keyword arguments are passed to <netCDF4.Dataset> when the file
+        is opened.
+        
+        """
+        key = self.key(f)
+        
+        if key in self.handles:
+            ncf, hmode, count = self.handles[key]
+            
+            if (mode != 'r') and (hmode == 'r'):
+                if count > 0:
+                    raise IOError('Cannot open %s with mode=%s while open read-only' % (f, mode))
+                ncf.close()
+                del self.handles[key]
+                
+        if key not in self.handles:
+            self.handles[key] = [Dataset(f, mode, **kwargs), mode, 0]
+            
+        self.handles[key][2] += 1
+        
+        return self.handles[key][0]
+    
+    def release(self, f):
+        """ Decrement reference count and close unused file outside sessions """
+        key = self.key(f)
+        self.handles[key][2] -= 1
+        
+        if (self.handles[key][2] <= 0) and (self.nsessions == 0):
+            self.close(f)
+    
+    def close(self, f):
+        """ Close file if open """
+        key = self.key(f)
+        
+        if key in self.handles:
+            ncf, hmode, count = self.handles.pop(key)
+            
+            if count > 0:
+                raise IOError('Cannot close %s while in use' % f)
+            ncf.close()
+    
+    def close_all(self):
+        """ Close all files that are not in use """
+        for key in self.handles.keys():
+            if self.handles[key][2] <= 0:
+                self.close(key)
+                
+
+_pool = DatasetPool()
+_lock = threading.RLock()
+
+
+@contextmanager
+def open_dataset(f, mode='r', **kwargs):
+    """ 
+    Context manager returning open dataset from shared pool. 
+    Other threads are blocked from netcdf access until it exits.
+    
+    """
+    with _lock:
+        ncf = _pool.acquire(f, mode=mode, **kwargs)
+        
+        try:
+            yield ncf
+        finally:
+            _pool.release(f)
+        
+
+@contextmanager
+def session():
+    """ 
+    Context manager that keeps files opened from shared pool 
+    open until the outermost session ends. 
+    
+    """
+    with _lock:
+        _pool.nsessions += 1
+    
+    try:
+        yield _pool
+    finally:
+        with _lock:
+            _pool.nsessions -= 1
+            
+            if _pool.nsessions == 0:
+                _pool.close_all()
+            
+
+@contextmanager
+def parallel_session(f, comm):
+    """
+    Context manager that opens file for parallel writes by all ranks
+    of an MPI communicator. The parallel handle is placed in the shared
+    pool so that it is used by <open_dataset> until the context ends.
+    
+    """
+    with _lock:
+        _pool.close(f)
+        key = _pool.key(f)
+        _pool.handles[key] = [Dataset(f, 'r+', parallel=True, comm=comm), 'r+', 1]
+        ncf = _pool.handles[key][0]
+    
+    try:
+        yield ncf
+    finally:
+        with _lock:
+            _pool.handles[key][2] -= 1
+            _pool.close(f)
+        
+
+@contextmanager
+def private_dataset(f, mode='r'):
+    """
+    Context manager returning dataset opened outside the shared pool,
+    so that worker processes can read a file concurrently using their 
+    own handles. The netCDF and HDF5 libraries are not thread-safe, so 
+    this must not be used by threads. The dataset is closed when the 
+    context ends.
+    
+    """
+    ncf = Dataset(f, mode)
+    
+    try:
+        yield ncf
+    finally:
+        ncf.close()
+        
+
+def has_parallel_support():
+    """ Return True if netCDF4 is built with support for parallel I/O """
+    return bool(getattr(netCDF4, '__has_parallel4_support__', False) or
+                getattr(netCDF4, '__has_pnetcdf_support__', False))
+
+
+def close(f):
+    """ Close file in shared pool, e.g. before it is replaced or deleted """
+    with _lock:
+        _pool.close(f)
+
+
+def configure(config):
+    """ 
+    Set HDF5 chunk cache used for files opened after this call
+    using configuration options.
+    
+    """
+    cache_mb = config.getfloat('options', 'chunk_cache_mb')
+    
+    if (cache_mb > 0) and hasattr(netCDF4, 'set_chunk_cache'):
+        size, nelems, preemption = netCDF4.get_chunk_cache()
+        netCDF4.set_chunk_cache(int(cache_mb * 1024 * 1024), nelems, preemption)
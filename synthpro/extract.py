@@ -7,59 +7,102 @@ import numpy as np
 
 import tools
 import printmsg
+import cache
+import multiproc
+import para
 
 
-def extract_profile(config, modelDat, ob_z, ob_lat, ob_lon, ob_dat):
-    """ Extract profile at an observed location """
+def global_index(modelDat, js, iis):
+    """ Return global j, i indices as floats with NaN where indices are masked """
+    mask = np.ma.getmaskarray(js)
+    syn_j = np.where(mask, np.nan, np.ma.getdata(js) + modelDat.jmin)
+    syn_i = np.where(mask, np.nan, np.ma.getdata(iis) + modelDat.imin)
+    
+    return syn_j, syn_i
 
-    mdl_dat, dist, j, i = modelDat.extract_profile(ob_lat, ob_lon)
-    mdl_z = modelDat.depths
-        
-    if config.getboolean('options', 'extract_full_depth'):
-        extr_z, extr_dat = tools.interp_fulldepth(mdl_z, mdl_dat, ob_z)
-    else:
-        extr_z, extr_dat = tools.interp_obsdepth(mdl_z, mdl_dat, ob_z, ob_dat)
 
-    return extr_z, extr_dat, dist, j, i
+def find_nearest(obsDat, modelDat, matchups=None, comm=None):
+    """
+    Return j, i indices and distances for nearest model grid-points
+    to all observed locations. If an MPI communicator is provided, only
+    observations routed to the tile of this rank are searched and 
+    observations shared with other tiles are kept by the rank holding 
+    the nearest grid-point. Other observations have masked j, i.
+    
+    """
+    if comm is None:
+        return modelDat.find_nearest_all(obsDat.lats, obsDat.lons, cache=matchups)
+    
+    nobs = len(obsDat.lats)
+    js = np.ma.masked_all(nobs, dtype=int)
+    iis = np.ma.masked_all(nobs, dtype=int)
+    dists = np.ones(nobs) * 1e20
+    
+    routed, shared = para.route_observations(
+        comm, modelDat.lats, modelDat.lons, obsDat.lats, obsDat.lons)
+    idx = np.where(routed)[0]
+    
+    if len(idx) > 0:
+        js[idx], iis[idx], dists[idx] = modelDat.find_nearest_all(
+            obsDat.lats[idx], obsDat.lons[idx], cache=matchups)
+    
+    lost = para.resolve_nearest(comm, dists, shared)
+    js[lost] = np.ma.masked
+    iis[lost] = np.ma.masked
+    dists[lost] = 1e20
+    
+    return js, iis, dists
+    
 
+def extract_profiles(config, obsDat, modelTemp, modelSal, comm=None):
+    """ 
+    Extract synthetic profiles from model data for each observed location
+    and return a dictionary of synthetic depths, temps, sals, dists and 
+    global i, j indices. If an MPI communicator is provided, profiles are 
+    only extracted for observations whose nearest grid-point lies in the 
+    tile of this rank.
+    
+    """
+    
+    nmax = len(obsDat.lats)
+    
+    # Find nearest-neighbours for all observed locations
+    matchups = cache.assoc_cache(config)
+    js_t, is_t, dists_t = find_nearest(obsDat, modelTemp, matchups=matchups, comm=comm)
+    js_s, is_s, dists_s = find_nearest(obsDat, modelSal, matchups=matchups, comm=comm)
+    
+    full_depth = config.getboolean('options', 'extract_full_depth')
+    
+    if config.getint('parallel', 'nprocs') > 1:
+        syn_depths, syn_temps, syn_sals = multiproc.extract_profiles(
+            config, obsDat, modelTemp, modelSal, (js_t, is_t), (js_s, is_s))
+    else:
+        syn_depths, syn_temps = tools.interp_profiles(
+            modelTemp.depths, modelTemp.extract_columns(js_t, is_t), 
+            obsDat.depths, obsDat.temps, full_depth=full_depth, 
+            mdl_nlev=modelTemp.extract_levels(js_t, is_t))
+        syn_depths, syn_sals = tools.interp_profiles(
+            modelSal.depths, modelSal.extract_columns(js_s, is_s), 
+            obsDat.depths, obsDat.sals, full_depth=full_depth, 
+            mdl_nlev=modelSal.extract_levels(js_s, is_s))
+        printmsg.extracting(config, nmax, nmax)
+    
+    syn_j, syn_i = global_index(modelSal, js_s, is_s)
+    
+    return {'depths': syn_depths, 'temps': syn_temps, 'sals': syn_sals,
+            'dists': dists_s, 'i': syn_i, 'j': syn_j}
 
-def extract_profiles(config, obsDat, synthDat, modelTemp, modelSal):
-    """ Extract synthetic profiles from model data for each observed location """
-    
-    nobs = np.arange(len(obsDat.lats))
-    nmax = nobs.max() + 1
-    syn_depths = synthDat.depths
-    syn_temps = synthDat.temps
-    syn_sals = synthDat.sals
-    syn_dist = np.array(synthDat.lats)
-    syn_i = np.array(synthDat.lats)
-    syn_j = np.array(synthDat.lats)
-    
-    for nob in nobs:        
-        ob_lat = obsDat.lats[nob]
-        ob_lon = obsDat.lons[nob]
-        ob_t = obsDat.temps[nob]
-        ob_s = obsDat.sals[nob]
-        ob_z = obsDat.depths[nob]
-                
-        syn_z, syn_t, dist, j, i = extract_profile(config, modelTemp, ob_z, ob_lat, ob_lon, ob_t)
-        syn_z, syn_s, dist, j, i = extract_profile(config, modelSal, ob_z, ob_lat, ob_lon, ob_s)
 
-        syn_depths[nob] = syn_z
-        syn_temps[nob] = syn_t
-        syn_sals[nob] = syn_s
-        syn_dist[nob] = dist
-        syn_i[nob] = i
-        syn_j[nob] = j
-        
-        printmsg.extracting(config, nob + 1, nmax)
-    
-    printmsg.writing(config)
-    synthDat.write_sals(syn_sals)
-    synthDat.write_temps(syn_temps)
-    synthDat.write_depths(syn_depths)
-    synthDat.write_dist(syn_dist)
-    synthDat.write_i(syn_i)
-    synthDat.write_j(syn_j)
-    
-        
+def write_profiles(config, synthDat, synthetic, rows=None, start=0):
+    """ 
+    Write synthetic profiles returned by <extract_profiles> to file
+    beginning at row start. If rows are specified, only those rows 
+    are written.
+    
+    """
+    synthDat.write_sals(synthetic['sals'], rows=rows, start=start)
+    synthDat.write_temps(synthetic['temps'], rows=rows, start=start)
+    synthDat.write_depths(synthetic['depths'], rows=rows, start=start)
+    synthDat.write_dist(synthetic['dists'], rows=rows, start=start)
+    synthDat.write_i(synthetic['i'], rows=rows, start=start)
+    synthDat.write_j(synthetic['j'], rows=rows, start=start)
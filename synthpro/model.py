@@ -3,135 +3,166 @@ Data classes for gridded model data.
 
 """
 
-from netCDF4 import Dataset
 import numpy as np
-
+import threading
+import functools
+import multiprocessing
 
 import tools
+import printmsg
+import datasets
+import colstore
+import multiproc
+
+
+# Read requests inherited by worker processes of <read_requests>
+_reader = {}
 
 
 class ShapeError(Exception):
     pass
 
-class ModelData(object):
+class GridFile(object):
     """
-    Class containing methods to read data from
-    a NEMO-type netcdf file.
+    Base class containing methods to read a sub-region of
+    gridded data from a NEMO-type netcdf file.
     
     """
-    def __init__(self, config, data_type, preload_data=True):
+    def __init__(self, config, data_type):
         """
-        Initialize <ModelData> object using configuration options
+        Initialize <GridFile> object using configuration options
         
-        """        
+        """
         self.f = config.get(data_type, 'file_name')
-        self.maskf = config.get(data_type, 'maskf')
-        self.mask_var = config.get(data_type, 'mask_var')
-        self.mask_mdi = config.getfloat(data_type, 'mask_mdi')
-        self.data_var = config.get(data_type, 'data_var')
-        self.depth_var = config.get(data_type, 'depth_var')
-        self.lat_var = config.get(data_type, 'lat_var')
-        self.lon_var = config.get(data_type, 'lon_var')
         self.imin = config.getint(data_type, 'imin')
         self.imax = config.getint(data_type, 'imax')
         self.jmin = config.getint(data_type, 'jmin')
         self.jmax = config.getint(data_type, 'jmax')
+        self.read_procs = config.getint('options', 'read_procs')
         self.test_ij_range()
-        self.mask_loaded = False 
-      
-        if preload_data:
-            self.load_data()
-            self.load_depths()
-            self.load_lats()
-            self.load_lons()
-            
         
+    def read_var(self, ncvar, altf=None, level=None):
+        """ 
+        Read data from specified variable. If level is specified, 
+        only that level of 3D variables is read.
         
-    def read_var(self, ncvar, altf=None):
-        """ Read data from specified variable """
-        if altf is None:
-            ncf = Dataset(self.f)
-        else:
-            ncf = Dataset(altf)
+        """
+        f = self.f if altf is None else altf
+        zslice = slice(None) if level is None else level
         
-        dat = ncf.variables[ncvar]
+        with datasets.open_dataset(f) as ncf:
+            dat = self.subset_var(ncf.variables[ncvar], zslice)
         
+        return dat
+    
+    def subset_var(self, dat, zslice=slice(None)):
+        """ Read ij range and levels in zslice from netcdf variable """
         if len(dat.shape) == 1:
             dat = dat[:]
         elif len(dat.shape) == 2:
             dat = dat[self.jmin:self.jmax+1, self.imin:self.imax+1]
         elif len(dat.shape) == 3:
-            dat = dat[:, self.jmin:self.jmax+1, self.imin:self.imax+1]
+            dat = dat[zslice, self.jmin:self.jmax+1, self.imin:self.imax+1]
         elif (len(dat.shape) == 4) & (dat.shape[0] == 1):
-            dat = dat[0, :, self.jmin:self.jmax+1, self.imin:self.imax+1]
+            dat = dat[0, zslice, self.jmin:self.jmax+1, self.imin:self.imax+1]
         else:
-            raise ShapeError('%s has invalid shape: &s', ncvar,
+            raise ShapeError('%s has invalid shape: &s', dat.name,
                              repr(dat.shape))
+            
+        return dat
+    
+    def count_levels(self, ncvar, levels=slice(None), altf=None):
+        """ Return number of levels of 3D variable in slice levels """
+        f = self.f if altf is None else altf
         
-        ncf.close()
+        with datasets.open_dataset(f) as ncf:
+            nz = ncf.variables[ncvar].shape[-3]
+            
+        return len(range(*levels.indices(nz)))
+    
+    def level_blocks(self, ncvar, levels=slice(None), altf=None):
+        """ 
+        Return blocks of levels of 3D variable in slice levels as a list
+        of slices, with about four blocks for each of read_procs processes.
         
-        return dat
-
-    def load_data(self):
-        """ Load data as <np.array> with dimensions [z, x, y] """
-        self.data = self.read_var(self.data_var)
-        self.test_shape(self.data_var, self.data.shape, 3)
-        self.test_ij_index(self.data_var, self.data[0])
-        self.load_mask()
-        self.data = tools.mask_data(self.data, self.mask, self.mask_mdi)
+        """
+        f = self.f if altf is None else altf
         
-    def load_depths(self):
-        """ Load depths as <np.array> with dimensions [z] """
-        self.depths = self.read_var(self.depth_var)
-        self.test_shape(self.depth_var, self.depths.shape, 1)
+        with datasets.open_dataset(f) as ncf:
+            start, stop, step = levels.indices(ncf.variables[ncvar].shape[-3])
+            
+        block_size = max(-(-(stop - start) // (4 * max(self.read_procs, 1))), 1)
         
-    def load_lats(self):
-        """ Load latitudes as <np.array> with dimensions [y, x]
-            and fill value of +1e20 """
-        self.lats = self.read_var(self.lat_var)
-        self.test_shape(self.lat_var, self.lats.shape, 2)
-        self.test_ij_index(self.lat_var, self.lats)
-        self.lats = tools.mask_data(
-            self.lats, self.mask[0], self.mask_mdi, fill_value=1e20)
-        self.lats = self.lats.filled()
+        return tools.chunk_slices(stop, block_size, start=start)
+    
+    def read_request(self, ncvar, out, blocks, altf=None, func=None, per_block=False):
+        """ 
+        Return request for <read_requests> to read blocks of levels of 3D
+        variable into out. If given, func is applied to the data of each 
+        block by the process that read it. Results are written to the 
+        levels of out for the block, counted from the first block, or to 
+        out[n] for the nth block if per_block is True.
         
-    def load_lons(self):
-        """ Load longitudes as <np.array> with dimensions [y, x] 
-            and fill value of +1e20 """
-        self.lons = self.read_var(self.lon_var)
-        self.test_shape(self.lon_var, self.lons.shape, 2)
-        self.test_ij_index(self.lon_var, self.lons)
-        self.lons = tools.mask_data(
-            self.lons, self.mask[0], self.mask_mdi, fill_value=1e20)
-        self.lons = self.lons.filled()
-
-    def load_mask(self):
-        """ Load longitudes as <np.array> with dimensions [z, y, x] """
-        if not self.mask_loaded:
-            self.mask = self.read_var(self.mask_var, altf=self.maskf)
-            self.test_shape(self.mask_var, self.mask.shape, 3)
-            self.test_ij_index(self.mask_var, self.mask[0])
-            self.mask_loaded = True
-
-    def find_nearest(self, lat, lon):
-        """ Extract model profile for the specified i, j coord."""
-        j, i, dist = tools.find_nearest_neigbour(lat, lon, self.lats, self.lons)
+        """
+        f = self.f if altf is None else altf
+        
+        return (self, f, ncvar, func, out, blocks, per_block)
 
-        return j, i, dist
+    def read_columns(self, ncvar, js, iis, altf=None, dtype=None, levels=slice(None)):
+        """ 
+        Read data from specified 3D variable at local j, i indices and 
+        return as <np.array> with dimensions [n, z] and missing values 
+        set to NaN. Columns are grouped by the file's chunk layout and 
+        each group is read as a single hyperslab bounding its columns, so 
+        that each chunk is read once and in storage order. Columns are 
+        returned as dtype if given and only cover the levels in slice levels.
+        
+        """
+        f = self.f if altf is None else altf
+        
+        with datasets.open_dataset(f) as ncf:
+            var = ncf.variables[ncvar]
+            
+            if len(var.shape) == 3:
+                lead = ()
+            elif (len(var.shape) == 4) & (var.shape[0] == 1):
+                lead = (0,)
+            else:
+                raise ShapeError('Shape=%s. Expected 3-D array for %s' %
+                                  (repr(var.shape), ncvar))
+            
+            self.test_ij_index(ncvar, np.empty(var.shape[-2:]))
+            nz = len(range(*levels.indices(var.shape[-3])))
+            
+            if dtype is None:
+                dtype = var.dtype if var.dtype.kind == 'f' else np.float64
+                
+            cols = np.ones((len(js), nz), dtype=dtype) * np.nan
+            
+            if len(js) > 0:
+                gj = np.asarray(js, dtype=np.int64) + self.jmin
+                gi = np.asarray(iis, dtype=np.int64) + self.imin
+                ty, tx = self.column_tiles(var)
+                tiles = (gj // ty) * (var.shape[-1] // tx + 1) + (gi // tx)
+                
+                for tile in np.unique(tiles):
+                    sel = np.where(tiles == tile)[0]
+                    jlo, jhi = gj[sel].min(), gj[sel].max()
+                    ilo, ihi = gi[sel].min(), gi[sel].max()
+                    block = var[lead + (levels, slice(jlo, jhi + 1), slice(ilo, ihi + 1))]
+                    cols[sel] = tools.fill_nan(block)[:, gj[sel] - jlo, gi[sel] - ilo].T
+        
+        return cols
     
-    def extract_profile(self, lat, lon):
-        """ Return model profile for the specified lat/lon 
-        and distance to observed location"""
-        j, i, dist = self.find_nearest(lat, lon)
+    def column_tiles(self, var, default=(64, 64)):
+        """ Return horizontal tile size used to group column reads """
+        chunks = var.chunking()
         
-        if (j is not None) and (i is not None):
-            dat = self.data[:, j, i]
-            i += self.imin 
-            j += self.jmin
-            return dat, dist, j, i
-        else:
-            return np.ma.MaskedArray(self.data[:, 0, 0], mask=True), dist, j, i
+        if chunks == 'contiguous' or chunks is None:
+            return default
         
+        return max(chunks[-2], 1), max(chunks[-1], 1)
+
     def test_shape(self, varname, varshape, ndim):
         if len(varshape) != ndim:
             raise ShapeError('Shape=%s. Expected %i-D array for %s' %
@@ -161,6 +192,617 @@ class ModelData(object):
             raise IndexError('Invalid min/max indices: imin=%i,imax=%i, jmin=%i,jmax=%i'
                               % (self.imin, self.imax, self.jmin, self.jmax))
 
+
+class GridGeometry(GridFile):
+    """
+    Class holding the land mask, coordinates and spatial index 
+    of a model grid. A single instance is shared by all model 
+    variables on the same grid so that these are only loaded, 
+    and nearest-neighbours are only searched for, once.
+    
+    """
+    def __init__(self, config, data_type, preload_data=True):
+        """
+        Initialize <GridGeometry> object using configuration options
+        
+        """
+        GridFile.__init__(self, config, data_type)
+        self.config = config
+        self.maskf = config.get(data_type, 'maskf')
+        self.mask_var = config.get(data_type, 'mask_var')
+        self.mask_mdi = config.getfloat(data_type, 'mask_mdi')
+        self.depth_var = config.get(data_type, 'depth_var')
+        self.lat_var = config.get(data_type, 'lat_var')
+        self.lon_var = config.get(data_type, 'lon_var')
+        self.kbottom = None
+        self.surface_mask = None
+        self.column_levels = None
+        self.depths = None
+        self.lats = None
+        self.lons = None
+        self.nn_index = None
+        self.nearest = None
+        self.matchup_key = None
+        
+        if preload_data:
+            self.load_surface_mask()
+            self.load_depths()
+            self.load_lats()
+            self.load_lons()
+
+    def load_kbottom(self):
+        """ 
+        Load number of levels from the surface to the deepest valid level
+        of each column as <np.array> with dimensions [y, x]. The mask is
+        read one level at a time, or in blocks of levels by read_procs 
+        processes, and is not retained. Columns are assumed to be valid from 
+        the surface down to their deepest valid level.
+        
+        """
+        if self.kbottom is None:
+            self.load_surface_mask()
+            kbottom = np.zeros(self.surface_mask.shape, dtype=np.int32)
+            
+            if self.read_procs > 1:
+                blocks = self.level_blocks(self.mask_var, altf=self.maskf)
+                counts = multiproc.empty_shared((len(blocks),) + kbottom.shape, np.int32)
+                read_requests([self.read_request(
+                    self.mask_var, counts, blocks, altf=self.maskf, per_block=True,
+                    func=functools.partial(wet_levels, mask_mdi=self.mask_mdi))], 
+                    self.read_procs)
+                
+                for block, nlev in zip(blocks, counts):
+                    kbottom[nlev > 0] = block.start + nlev[nlev > 0]
+            else:
+                for k in range(self.count_levels(self.mask_var, altf=self.maskf)):
+                    level = self.surface_mask if k == 0 else self.read_var(
+                        self.mask_var, altf=self.maskf, level=k)
+                    kbottom[np.ma.filled(level != self.mask_mdi, False)] = k + 1
+                
+            self.kbottom = kbottom
+            
+    def load_surface_mask(self):
+        """ Load surface level of mask as <np.array> with dimensions [y, x] """
+        if self.surface_mask is None:
+            self.surface_mask = self.read_var(self.mask_var, altf=self.maskf, level=0)
+            self.test_shape(self.mask_var, self.surface_mask.shape, 2)
+            self.test_ij_index(self.mask_var, self.surface_mask)
+            
+    def extract_levels(self, js, iis, levels=slice(None)):
+        """ 
+        Return number of valid levels with dimensions [n] for the specified 
+        j, i indices. Masked j, i indices have no valid levels. If the bottom
+        levels of all columns are not loaded, levels are found from the mask
+        columns at the specified j, i indices within slice levels, so that 
+        only those columns of the mask are read.
+        
+        """
+        jj, ii = np.ma.filled(js, 0), np.ma.filled(iis, 0)
+        
+        if self.kbottom is not None:
+            nlev = self.kbottom[jj, ii]
+        else:
+            nlev = self.extract_column_levels(jj, ii, levels=levels)
+        
+        return np.where(np.ma.getmaskarray(js), 0, nlev)
+    
+    def extract_column_levels(self, js, iis, levels=slice(None)):
+        """ 
+        Return number of levels down to the deepest valid level within 
+        slice levels of the mask columns at local j, i indices. Levels 
+        found for the most recent set of indices are retained and reused 
+        by subsequent calls.
+        
+        """
+        key = (tools.hash_arrays(js, iis), levels.start, levels.stop, levels.step)
+        
+        if (self.column_levels is None) or (self.column_levels[0] != key):
+            mask = self.read_columns(self.mask_var, js, iis, altf=self.maskf, levels=levels)
+            wet = ~np.isnan(mask) & (mask != self.mask_mdi)
+            nlev = np.where(wet.any(axis=1), wet.shape[1] - wet[:, ::-1].argmax(axis=1), 0)
+            self.column_levels = (key, nlev)
+            
+        return self.column_levels[1]
+        
+    def load_depths(self):
+        """ Load depths as <np.array> with dimensions [z] """
+        if self.depths is None:
+            self.depths = self.read_var(self.depth_var)
+            self.test_shape(self.depth_var, self.depths.shape, 1)
+        
+    def load_lats(self):
+        """ Load latitudes as <np.array> with dimensions [y, x]
+            and fill value of +1e20 """
+        if self.lats is None:
+            self.load_surface_mask()
+            lats = self.read_var(self.lat_var)
+            self.test_shape(self.lat_var, lats.shape, 2)
+            self.test_ij_index(self.lat_var, lats)
+            lats = tools.mask_data(
+                lats, self.surface_mask, self.mask_mdi, fill_value=1e20)
+            self.lats = lats.filled()
+        
+    def load_lons(self):
+        """ Load longitudes as <np.array> with dimensions [y, x] 
+            and fill value of +1e20 """
+        if self.lons is None:
+            self.load_surface_mask()
+            lons = self.read_var(self.lon_var)
+            self.test_shape(self.lon_var, lons.shape, 2)
+            self.test_ij_index(self.lon_var, lons)
+            lons = tools.mask_data(
+                lons, self.surface_mask, self.mask_mdi, fill_value=1e20)
+            self.lons = lons.filled()
+
+    def build_index(self):
+        """ Build spatial index of valid model grid-points """
+        if self.nn_index is None:
+            self.load_lats()
+            self.load_lons()
+            self.nn_index = tools.NearestNeighbourIndex(self.lats, self.lons)
+            
+            if tools.cKDTree is None:
+                printmsg.message(self.config, 'WARNING: scipy not available. '
+                                 'Nearest-neighbour searches will use a brute-force scan.')
+
+    def find_nearest_all(self, lats, lons, cache=None):
+        """ 
+        Return j, i indices and distances for nearest model grid-points 
+        to all observed locations using a single query of the spatial index.
+        Observations without a valid model grid-point have masked j, i.
+        The result for the most recent set of observed locations is
+        retained and reused by subsequent calls. If a <MatchupCache> is
+        provided, it is consulted before searching and updated afterwards.
+        
+        """
+        obs_key = tools.hash_arrays(lats, lons)
+        
+        if (self.nearest is not None) and (self.nearest[0] == obs_key):
+            return self.nearest[1]
+        
+        nearest = None
+        
+        if cache is not None:
+            cache_key = cache.key(self, lats, lons)
+            nearest = cache.load(cache_key)
+            
+        if nearest is None:
+            self.build_index()
+            nearest = self.nn_index.query(lats, lons)
+            
+            if cache is not None:
+                cache.save(cache_key, *nearest)
+        
+        self.nearest = (obs_key, nearest)
+        
+        return nearest
+
+
+class ModelData(GridFile):
+    """
+    Class containing methods to read data from
+    a NEMO-type netcdf file.
+    
+    """
+    def __init__(self, config, data_type, preload_data=True, grid=None, 
+                 read_columns=False, store=None, ocean_only=False, max_depth=None):
+        """
+        Initialize <ModelData> object using configuration options. 
+        Mask, coordinates and nearest-neighbour searches are taken 
+        from a shared <GridGeometry> object if provided. If read_columns
+        is True, the 3D data field is not loaded and only the model 
+        columns requested by <extract_columns> are read from file. If
+        a <ColumnStore> is provided, model data are memory-mapped from 
+        the store instead of being read from the netcdf file. If ocean_only
+        is True, loaded data are held as <tools.OceanColumns> containing
+        only ocean columns rather than as a 3D array. If max_depth is given,
+        only levels down to the first level at or below max_depth, and one 
+        level beneath it, are read. Levels are not subset for data read 
+        from a <ColumnStore>.
+        
+        """        
+        GridFile.__init__(self, config, data_type)
+        self.data_var = config.get(data_type, 'data_var')
+        self.dtype = tools.data_dtype(config)
+        self.lazy = read_columns
+        self.store = store
+        self.stored = None
+        self.ocean_only = ocean_only
+        self.columns = None
+        self.raw = None
+        self.levels = slice(None)
+        
+        if grid is None:
+            grid = GridGeometry(config, data_type, preload_data=False)
+            
+        self.grid = grid
+        self.maskf = grid.maskf
+        self.mask_var = grid.mask_var
+        self.mask_mdi = grid.mask_mdi
+        self.depth_var = grid.depth_var
+        self.lat_var = grid.lat_var
+        self.lon_var = grid.lon_var
+        
+        if (max_depth is not None) and (store is None):
+            self.levels = self.find_levels(max_depth)
+      
+        if preload_data:
+            self.load()
+            
+    def load(self):
+        """ Load data unless read_columns is True, depths and coordinates """
+        if not self.lazy:
+            self.load_data()
+        elif self.store is not None:
+            self.load_stored()
+        self.load_depths()
+        self.load_lats()
+        self.load_lons()
+
+    def load_data(self):
+        """ 
+        Load data as <np.array> with dimensions [z, x, y] and NaN below
+        the sea floor or as <tools.OceanColumns> if ocean_only is True.
+        
+        """
+        if self.ocean_only:
+            self.load_columns()
+        elif self.store is not None:
+            self.load_stored()
+            self.data = self.stored.to_grid()
+        else:
+            self.data = self.read_data()
+            
+    def read_data(self):
+        """ Read data from netcdf file and set levels below the sea floor to NaN """
+        dat = self.read_raw()
+        
+        return tools.mask_levels(dat, self.kbottom)
+    
+    def read_raw(self):
+        """ 
+        Read data from netcdf file with dimensions [z, y, x] in the 
+        configured precision and with missing values set to NaN. If
+        read_procs is greater than one, blocks of levels are read
+        by worker processes. Data already read by <load_models> are
+        used instead of reading the file.
+        
+        """
+        if self.raw is None:
+            if self.read_procs > 1:
+                read_requests([self.raw_request()], self.read_procs)
+            else:
+                self.raw = self.read_var(self.data_var, level=self.levels)
+        
+        dat, self.raw = self.raw, None
+        self.test_shape(self.data_var, dat.shape, 3)
+        self.test_ij_index(self.data_var, dat[0])
+        self.load_kbottom()
+        
+        return tools.fill_nan(dat, dtype=self.dtype)
+    
+    def raw_request(self):
+        """ 
+        Return request for <read_requests> to read data in blocks of
+        levels into raw, which is allocated in shared memory with 
+        dimensions [z, y, x]. Each block is converted to the configured 
+        precision by the process that read it.
+        
+        """
+        blocks = self.level_blocks(self.data_var, levels=self.levels)
+        
+        with datasets.open_dataset(self.f) as ncf:
+            var = ncf.variables[self.data_var]
+            ny = len(range(*slice(self.jmin, self.jmax + 1).indices(var.shape[-2])))
+            nx = len(range(*slice(self.imin, self.imax + 1).indices(var.shape[-1])))
+            dtype = self.dtype
+            
+            if dtype is None:
+                packed = ('scale_factor' in var.ncattrs()) or ('add_offset' in var.ncattrs())
+                dtype = var.dtype if (var.dtype.kind == 'f') and not packed else np.float64
+                
+        nz = blocks[-1].stop - blocks[0].start if blocks else 0
+        self.raw = multiproc.empty_shared((nz, ny, nx), dtype)
+        
+        return self.read_request(self.data_var, self.raw, blocks, 
+                                 func=functools.partial(tools.fill_nan, dtype=dtype))
+    
+    def reads_field(self):
+        """ Return True if loading reads the 3D data field from the netcdf file """
+        return (not self.lazy) and (self.store is None)
+    
+    def load_columns(self):
+        """ Load ocean columns as <tools.OceanColumns> with dimensions [n, z] """
+        if self.columns is None:
+            if self.store is not None:
+                self.load_stored()
+                self.columns = self.stored
+            else:
+                self.columns = tools.OceanColumns.from_levels(
+                    self.read_raw(), self.kbottom, dtype=self.dtype)
+    
+    def load_stored(self):
+        """ 
+        Memory-map ocean columns from the <ColumnStore>. If the store 
+        entry is missing or out of date, it is built from the netcdf file.
+        
+        """
+        if self.stored is None:
+            self.stored = self.store.load(self)
+            
+            if self.stored is None:
+                self.store.save(self, tools.OceanColumns.from_levels(
+                    self.read_raw(), self.kbottom, dtype=np.float32))
+                self.stored = self.store.load(self)
+        
+    def find_levels(self, max_depth):
+        """ 
+        Return slice of levels from the surface down to one level beneath 
+        the first level at or below max_depth. All levels are used when
+        max_depth is below the deepest level, and two levels are used 
+        when max_depth is NaN.
+        
+        """
+        self.grid.load_depths()
+        depths = self.grid.depths
+        k = 0 if np.isnan(max_depth) else np.searchsorted(depths, max_depth, side='left')
+        
+        return slice(0, int(min(k + 2, len(depths))))
+        
+    def load_depths(self):
+        """ Load depths of levels used as <np.array> with dimensions [z] """
+        self.grid.load_depths()
+        self.depths = self.grid.depths[self.levels]
+        
+    def load_lats(self):
+        """ Load latitudes as <np.array> with dimensions [y, x]
+            and fill value of +1e20 """
+        self.grid.load_lats()
+        self.lats = self.grid.lats
+        
+    def load_lons(self):
+        """ Load longitudes as <np.array> with dimensions [y, x] 
+            and fill value of +1e20 """
+        self.grid.load_lons()
+        self.lons = self.grid.lons
+
+    def load_kbottom(self):
+        """ Load number of valid levels used in each column as <np.array> with dimensions [y, x] """
+        self.grid.load_kbottom()
+        self.kbottom = self.clip_levels(self.grid.kbottom)
+        
+    def extract_levels(self, js, iis):
+        """ 
+        Return number of valid levels used with dimensions [n] for the 
+        specified j, i indices. Levels are taken from the ocean columns
+        if these are held in memory or in a <ColumnStore>, and from the 
+        shared <GridGeometry> otherwise.
+        
+        """
+        jj, ii = np.ma.filled(js, 0), np.ma.filled(iis, 0)
+        
+        if self.columns is not None:
+            nlev = self.columns.levels(jj, ii)
+        elif self.lazy and (self.store is not None):
+            self.load_stored()
+            nlev = self.stored.levels(jj, ii)
+        else:
+            nlev = self.grid.extract_levels(js, iis, levels=self.levels)
+            
+        return self.clip_levels(np.where(np.ma.getmaskarray(js), 0, nlev))
+    
+    def clip_levels(self, nlev):
+        """ Return numbers of levels limited to the levels used """
+        if self.levels.stop is None:
+            return nlev
+        
+        return np.minimum(nlev, self.levels.stop)
+
+    def build_index(self):
+        """ Build spatial index of valid model grid-points """
+        self.grid.build_index()
+        self.nn_index = self.grid.nn_index
+
+    def find_nearest(self, lat, lon):
+        """ Return j, i index and distance for nearest model grid-point """
+        j, i, dist = self.find_nearest_all(np.array([lat]), np.array([lon]))
+        
+        if j.mask[0]:
+            return None, None, dist[0]
+        
+        return j[0], i[0], dist[0]
+    
+    def find_nearest_all(self, lats, lons, cache=None):
+        """ 
+        Return j, i indices and distances for nearest model grid-points 
+        to all observed locations using the shared <GridGeometry>.
+        
+        """
+        return self.grid.find_nearest_all(lats, lons, cache=cache)
+    
+    def extract_column(self, j, i):
+        """ Return model profile for the specified j, i index """
+        if self.columns is not None:
+            js = np.ma.masked_array([0 if j is None else j], mask=[j is None])
+            iis = np.ma.masked_array([0 if i is None else i], mask=[i is None])
+            return self.extract_columns(js, iis)[0]
+        elif (j is not None) and (i is not None):
+            return self.data[:, j, i]
+        else:
+            return np.ones_like(self.data[:, 0, 0]) * np.nan
+    
+    def extract_columns(self, js, iis):
+        """ 
+        Return model profiles with dimensions [n, z] for the specified
+        j, i indices. Missing values and profiles with masked j, i indices
+        are returned as NaN.
+        
+        """
+        jj, ii = np.ma.filled(js, 0), np.ma.filled(iis, 0)
+        
+        if self.columns is not None:
+            cols = self.columns.gather(jj, ii)
+        elif self.lazy and (self.store is not None):
+            self.load_stored()
+            cols = self.stored.gather(jj, ii)
+        elif self.lazy:
+            cols = self.read_columns(self.data_var, jj, ii, dtype=self.dtype, 
+                                     levels=self.levels)
+            cols = tools.mask_levels(cols, self.extract_levels(js, iis), axis=-1)
+        else:
+            cols = self.data[:, jj, ii].T
+            
+        cols[np.ma.getmaskarray(js)] = np.nan
+        
+        return cols
+    
+    def extract_profile(self, lat, lon):
+        """ Return model profile for the specified lat/lon 
+        and distance to observed location"""
+        j, i, dist = self.find_nearest(lat, lon)
+        dat = self.extract_column(j, i)
+        
+        if (j is not None) and (i is not None):
+            i += self.imin 
+            j += self.jmin
+            
+        return dat, dist, j, i
+
+
+def concurrent_reads():
+    """ 
+    Return True if worker processes can be used to read model data. 
+    Workers are only forked from the main thread of the main process, 
+    as the netCDF and HDF5 libraries are not thread-safe and pool 
+    workers cannot start their own workers.
+    
+    """
+    return (isinstance(threading.current_thread(), threading._MainThread) and 
+            isinstance(multiprocessing.current_process(), multiprocessing.process._MainProcess))
+
+
+def read_requests(requests, nprocs):
+    """ 
+    Read blocks of levels for requests made by <GridFile.read_request>. 
+    Blocks of all requests are read by a single pool of nprocs worker
+    processes, so that several variables are read at once. Each process 
+    opens files with its own handle and writes blocks directly into the
+    output arrays in shared memory. If worker processes cannot be used,
+    blocks are read one at a time through the shared dataset pool.
+    
+    """
+    tasks = [(r, n) for r, request in enumerate(requests) for n in range(len(request[5]))]
+    
+    if (nprocs <= 1) or not concurrent_reads():
+        for r, n in tasks:
+            with datasets.open_dataset(requests[r][1]) as ncf:
+                store_block(requests[r], n, ncf)
+        return
+    
+    # Close shared handles so that they are not inherited by worker processes
+    for f in set(request[1] for request in requests):
+        datasets.close(f)
+        
+    _reader['requests'] = requests
+    pool = multiprocessing.Pool(nprocs)
+    
+    try:
+        for _ in pool.imap_unordered(read_block, tasks):
+            pass
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _reader.clear()
+
+
+def read_block(task):
+    """ 
+    Read block n of request r given by task=(r, n) for <read_requests> 
+    in a worker process using its own file handle.
+    
+    """
+    request = _reader['requests'][task[0]]
+    
+    with datasets.private_dataset(request[1]) as ncf:
+        store_block(request, task[1], ncf)
+
+
+def store_block(request, n, ncf):
+    """ Read block n of request from open dataset and write it to the output array """
+    gridf, f, ncvar, func, out, blocks, per_block = request
+    dat = gridf.subset_var(ncf.variables[ncvar], blocks[n])
+    dat = dat if func is None else func(dat)
+    
+    if per_block:
+        out[n] = dat
+    else:
+        k0 = blocks[n].start - blocks[0].start
+        out[k0:k0 + len(dat)] = dat
+
+
+def wet_levels(mask, mask_mdi):
+    """ 
+    Return number of levels down to the deepest valid level in a block
+    of the mask with dimensions [z, y, x], or zero for land columns.
+    
+    """
+    wet = np.ma.filled(mask != mask_mdi, False)
+    
+    return np.where(wet.any(axis=0), len(wet) - wet[::-1].argmax(axis=0), 0)
+
+
+def grid_key(config, data_type):
+    """ 
+    Return key identifying the model grid used by data_type. Model 
+    variables that share a land mask, coordinate variables and ij range
+    are assumed to share a grid.
+    
+    """
+    key = tuple(config.get(data_type, opt) for opt in 
+                ['maskf', 'mask_var', 'mask_mdi', 'depth_var', 'lat_var', 'lon_var'])
+    key += tuple(config.getint(data_type, opt) for opt in 
+                 ['imin', 'imax', 'jmin', 'jmax'])
+    
+    return key
+
+
+_grids = {}
+
+def assoc_grid(config, data_type, preload_data=True):
+    """
+    Return shared <GridGeometry> object for the grid used by data_type.
+    
+    """
+    key = grid_key(config, data_type)
+    
+    if key not in _grids:
+        _grids[key] = GridGeometry(config, data_type, preload_data=preload_data)
+        
+    return _grids[key]
+
+
+def clear_grids():
+    """ Remove all shared <GridGeometry> objects """
+    _grids.clear()
+
+
+def retain_grids(config, data_types=('model_temp', 'model_sal')):
+    """ 
+    Remove shared <GridGeometry> objects other than those used by 
+    data_types, so that grids of earlier tiles are not kept when the 
+    ij range changes between runs.
+    
+    """
+    keys = [grid_key(config, data_type) for data_type in data_types]
+    
+    for key in _grids.keys():
+        if key not in keys:
+            del _grids[key]
+
+
 def assoc_model(config, data_type, **kwargs):
     """
     Return model class object of appropriate type
@@ -168,6 +810,22 @@ def assoc_model(config, data_type, **kwargs):
     
     """
     model_type = config.get(data_type, 'model_type')
+    
+    if 'grid' not in kwargs:
+        kwargs['grid'] = assoc_grid(config, data_type, 
+                                    preload_data=kwargs.get('preload_data', True))
+        
+    if 'read_columns' not in kwargs:
+        kwargs['read_columns'] = config.getboolean('options', 'read_columns')
+        
+    if 'store' not in kwargs:
+        kwargs['store'] = colstore.assoc_store(config)
+        
+    if 'ocean_only' not in kwargs:
+        kwargs['ocean_only'] = config.getboolean('options', 'ocean_only')
+        
+    if config.getboolean('options', 'extract_full_depth'):
+        kwargs['max_depth'] = None
           
     if model_type == 'NEMO':
         modelDat = ModelData(config, data_type, **kwargs)
@@ -180,3 +838,37 @@ def assoc_model(config, data_type, **kwargs):
 
  
 
+
+
+
+def assoc_models(config, data_types=('model_temp', 'model_sal'), **kwargs):
+    """ Return model class objects for each of data_types loaded by <load_models> """
+    preload_data = kwargs.pop('preload_data', True)
+    models = [assoc_model(config, data_type, preload_data=False, **kwargs) 
+              for data_type in data_types]
+    
+    if preload_data:
+        load_models(models)
+        
+    return models
+
+
+def load_models(models):
+    """ 
+    Load model class objects. If read_procs is greater than one, the 
+    data fields of all models read from netcdf files are read by a 
+    single pool of worker processes, so that variables are decompressed 
+    concurrently as well as blocks of levels.
+    
+    """
+    fields = [modelDat for modelDat in models if modelDat.reads_field()]
+    nprocs = max([modelDat.read_procs for modelDat in fields] + [1])
+    
+    if (len(fields) > 1) and (nprocs > 1):
+        for modelDat in fields:
+            modelDat.load_kbottom()
+            
+        read_requests([modelDat.raw_request() for modelDat in fields], nprocs)
+    
+    for modelDat in models:
+        modelDat.load()
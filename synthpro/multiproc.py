@@ -0,0 +1,140 @@
+"""
+Routines to extract synthetic profiles using a pool of 
+processes on a single compute node.
+
+"""
+
+import ctypes
+import multiprocessing
+import numpy as np
+
+import tools
+import printmsg
+
+
+# Arrays and objects inherited by worker processes
+_shared = {}
+
+
+def empty_shared(shape, dtype):
+    """ Return uninitialized array backed by shared memory """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = multiprocessing.RawArray(ctypes.c_byte, max(size * dtype.itemsize, 1))
+    
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+def share_array(arr):
+    """ Return copy of array backed by shared memory """
+    arr = np.asarray(arr)
+    shared = empty_shared(arr.shape, arr.dtype)
+    shared[...] = arr
+    
+    return shared
+
+
+def share_model(modelDat, js, iis):
+    """ 
+    Return source of model profiles for worker processes. Model data 
+    loaded in memory are moved to shared memory once and indexed by 
+    workers. Ocean columns memory-mapped from a column store are already 
+    shared between processes. Otherwise, model columns are read by the 
+    parent process and shared.
+    
+    """
+    if modelDat.lazy:
+        return share_array(modelDat.extract_columns(js, iis)), None, None
+    
+    if not getattr(modelDat, 'data_shared', False):
+        if modelDat.columns is None:
+            modelDat.data = share_array(modelDat.data)
+        elif not isinstance(modelDat.columns.values, np.memmap):
+            modelDat.columns.values = share_array(modelDat.columns.values)
+        modelDat.data_shared = True
+        
+    return modelDat, js, iis
+    
+
+def model_columns(source, rows):
+    """ Return model profiles for rows from shared source """
+    modelDat, js, iis = source
+    
+    if js is None:
+        return modelDat[rows]
+    
+    return modelDat.extract_columns(js[rows], iis[rows])
+
+
+def store(name, rows, dat):
+    """ Store results for rows in shared output arrays """
+    _shared[name][rows] = dat
+    
+    
+def extract_chunk(chunk):
+    """ Extract synthetic profiles for a chunk of observations """
+    rows = slice(*chunk)
+    ob_z = _shared['ob_z'][rows]
+    
+    for name in ['temps', 'sals']:
+        syn_z, syn_dat = tools.interp_profiles(
+            _shared['mdl_z'], model_columns(_shared['mdl_' + name], rows), 
+            ob_z, _shared['ob_' + name][rows], full_depth=_shared['full_depth'],
+            mdl_nlev=_shared['nlev_' + name][rows])
+        store('syn_' + name, rows, syn_dat)
+        store('syn_depths', rows, syn_z)
+        
+    return chunk[1] - chunk[0]
+
+
+def output_array(like):
+    """ Return shared output array filled with NaN """
+    return share_array(np.ones(like.shape, dtype=like.dtype) * np.nan)
+
+
+def extract_profiles(config, obsDat, modelTemp, modelSal, nearest_t, nearest_s):
+    """ 
+    Extract synthetic profiles using a pool of worker processes. 
+    Observations are split into chunks that are handed to workers 
+    and results are assembled in their original order. Model and 
+    observed data are placed in shared memory before workers are 
+    started so that they are not copied to each process.
+    
+    """
+    nprocs = config.getint('parallel', 'nprocs')
+    chunk_size = config.getint('parallel', 'obs_chunk_size')
+    nmax = len(obsDat.lats)
+    chunks = [(n0, min(n0 + chunk_size, nmax)) for n0 in range(0, nmax, chunk_size)]
+    
+    _shared['full_depth'] = config.getboolean('options', 'extract_full_depth')
+    _shared['mdl_z'] = modelTemp.depths
+    _shared['mdl_temps'] = share_model(modelTemp, *nearest_t)
+    _shared['mdl_sals'] = share_model(modelSal, *nearest_s)
+    _shared['nlev_temps'] = share_array(modelTemp.extract_levels(*nearest_t))
+    _shared['nlev_sals'] = share_array(modelSal.extract_levels(*nearest_s))
+    _shared['ob_z'] = share_array(tools.fill_nan(obsDat.depths, dtype=np.float64))
+    _shared['ob_temps'] = share_array(tools.fill_nan(obsDat.temps))
+    _shared['ob_sals'] = share_array(tools.fill_nan(obsDat.sals))
+    _shared['syn_depths'] = output_array(_shared['ob_z'])
+    _shared['syn_temps'] = output_array(_shared['ob_temps'])
+    _shared['syn_sals'] = output_array(_shared['ob_sals'])
+    
+    pool = multiprocessing.Pool(nprocs)
+    ndone = 0
+    
+    try:
+        for n in pool.imap_unordered(extract_chunk, chunks):
+            ndone += n
+            printmsg.extracting(config, ndone, nmax)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    
+    syn = [_shared.pop(name) for name in 
+           ['syn_depths', 'syn_temps', 'syn_sals']]
+    _shared.clear()
+    
+    return syn
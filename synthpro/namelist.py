@@ -6,6 +6,36 @@ Routines to parse configuration file options.
 import ConfigParser
 
 
+# Default values for optional sections and options
+DEFAULTS = [
+    ('cache', 'use_cache', 'False'),
+    ('cache', 'cache_dir', './cache/'),
+    ('cache', 'max_mb', '1024'),
+    ('store', 'use_store', 'False'),
+    ('store', 'store_dir', './store/'),
+    ('parallel', 'nprocs', '1'),
+    ('parallel', 'obs_chunk_size', '2000'),
+    ('parallel', 'parallel_output', 'False'),
+    ('parallel', 'decomposition', 'regular'),
+    ('parallel', 'scheduling', 'static'),
+    ('parallel', 'obs_weight', '10'),
+    ('options', 'read_columns', 'False'),
+    ('options', 'ocean_only', 'False'),
+    ('options', 'chunk_cache_mb', '0'),
+    ('options', 'prefetch', 'False'),
+    ('options', 'stream_chunk_size', '0'),
+    ('options', 'single_precision', 'False'),
+    ('options', 'read_procs', '1'),
+    ('output', 'zlib', 'False'),
+    ('output', 'complevel', '4'),
+    ('output', 'shuffle', 'True'),
+    ('output', 'profile_chunk_size', '0'),
+    ('output', 'pack_data', 'False'),
+    ('output', 'pack_scale', '0.001'),
+    ('output', 'pack_offset', '20'),
+    ]
+
+
 def get_namelist(args):
     """
     Return configuration options as <ConfigParser> object.
@@ -13,6 +43,23 @@ def get_namelist(args):
     """
     config = ConfigParser.ConfigParser()
     config.read(args.namelist)
+    config = set_defaults(config)
+    
+    return config
+
+
+def set_defaults(config):
+    """
+    Add default values for optional options missing from
+    configuration file.
     
+    """
+    for section, option, value in DEFAULTS:
+        if not config.has_section(section):
+            config.add_section(section)
+            
+        if not config.has_option(section, option):
+            config.set(section, option, value)
+            
     return config
 
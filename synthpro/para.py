@@ -6,54 +6,199 @@ Housekeeping routines for running SynthPro in parallel using openMPI.
 import numpy as np
 
 import tools
-import profiles
 import printmsg
+import datasets
+import model
+import profiles
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    pass
+
+
+def latlon_bins(lats, lons, binsize=1.):
+    """ Return j, i indices of regular lat/lon bins containing each location """
+    nlat, nlon = int(round(180. / binsize)), int(round(360. / binsize))
+    jbins = np.clip(np.floor((np.asarray(lats) + 90.) / binsize), 0, nlat - 1)
+    ibins = np.floor(np.mod(lons, 360.) / binsize) % nlon
+    
+    return jbins.astype(int), ibins.astype(int)
+
 
-def combine_profiles(args, config, size):
+def footprint(lats, lons, halo=2., binsize=1.):
     """
-    Combine synthetic profiles returned by each process and 
-    choose between any  duplicates using the minimum distance between 
-    ob and model location.
+    Return boolean map of regular lat/lon bins that lie within halo 
+    degrees of latitude and longitude of any valid model grid-point.
+    Invalid grid-points are identified by a fill value of +1e20. 
     
     """
-    synthDatFinal = profiles.assoc_profiles(config, 'synth_profiles')
+    nlat, nlon = int(round(180. / binsize)), int(round(360. / binsize))
+    valid = lats < 1e20
+    occupied = np.zeros((nlat, nlon), dtype=bool)
+    jbins, ibins = latlon_bins(lats[valid], lons[valid], binsize=binsize)
+    occupied[jbins, ibins] = True
     
-    for nf in np.arange(size)[1:]:
-        printmsg.combining(config, nf+1, size)
-        oldsuffix = '_core%i.nc' % (nf - 1)
-        newsuffix = '_core%i.nc' % (nf)
-        
-        config = update_fpattern(config, 'synth_profiles',
-                  oldsuffix=oldsuffix, newsuffix=newsuffix)
-        config = tools.build_file_name(args, config, 'synth_profiles')
-        synthDat = profiles.assoc_profiles(config, 'synth_profiles')
-        
-        ind = np.where(synthDat.dists < synthDatFinal.dists)
-        if tools.idx_is_valid(ind):
-            synthDatFinal.dists[ind] = synthDat.dists[ind]
-            synthDatFinal.temps[ind] = synthDat.temps[ind]
-            synthDatFinal.sals[ind] = synthDat.sals[ind]
-            synthDatFinal.depths[ind] = synthDat.depths[ind]
+    nhalo = int(np.ceil(halo / binsize))
+    fp = np.zeros_like(occupied)
+    
+    for dj in range(-nhalo, nhalo + 1):
+        shifted = np.zeros_like(occupied)
+        if dj >= 0:
+            shifted[dj:] = occupied[:nlat - dj]
+        else:
+            shifted[:dj] = occupied[-dj:]
+        for di in range(-nhalo, nhalo + 1):
+            fp |= np.roll(shifted, di, axis=1)
+    
+    return fp
+
+
+def route_observations(comm, lats, lons, obs_lats, obs_lons, halo=2., binsize=1.):
+    """
+    Route observations to the MPI ranks whose tile, extended by a 
+    halo equal to the nearest-neighbour tolerance, contains them.
+    Tile footprints are exchanged between all ranks so that every 
+    rank holds the same routing. Returns a boolean array flagging 
+    observations routed to this rank and a boolean array flagging 
+    observations routed to more than one rank.
+    
+    """
+    fp = footprint(lats, lons, halo=halo, binsize=binsize)
+    fps = np.empty((comm.Get_size(),) + fp.shape, dtype=fp.dtype)
+    comm.Allgather(fp, fps)
+    
+    jbins, ibins = latlon_bins(obs_lats, obs_lons, binsize=binsize)
+    routes = fps[:, jbins, ibins]
+    routed = routes[comm.Get_rank()]
+    shared = routes.sum(axis=0) > 1
+    
+    return routed, shared
+
+
+def resolve_nearest(comm, dists, shared):
+    """
+    Resolve observations routed to more than one rank using a 
+    minimum-distance reduction across ranks. Ties are given to the
+    lowest rank. Returns a boolean array flagging observations that
+    are held by a closer grid-point on another rank.
+    
+    """
+    idx = np.where(shared)[0]
+    owner = nearest_rank(comm, dists[idx])
+    
+    lost = np.zeros(len(dists), dtype=bool)
+    lost[idx] = owner != comm.Get_rank()
+    
+    return lost
+
+
+def nearest_rank(comm, dists):
+    """
+    Return rank holding the minimum distance for each observation, 
+    found as a MINLOC reduction using buffer-based MIN reductions of 
+    distance and then of rank. Ties are given to the lowest rank. 
+    Observations without a valid distance on any rank are given the 
+    number of ranks.
+    
+    """
+    local = np.ascontiguousarray(dists, dtype=np.float64)
+    mindist = np.empty_like(local)
+    comm.Allreduce(local, mindist, op=MPI.MIN)
+    
+    valid = (local == mindist) & (local < 1e20)
+    candidate = np.where(valid, comm.Get_rank(), comm.Get_size()).astype(np.int32)
+    owner = np.empty_like(candidate)
+    comm.Allreduce(candidate, owner, op=MPI.MIN)
+    
+    return owner
+
+
+def reduce_profiles(config, comm, synthetic, root=0):
+    """
+    Combine synthetic profiles extracted by each rank in memory on the
+    root rank. The rank holding the closest grid-point to each observation
+    is found by <nearest_rank>, and each rank sends only the rows it holds 
+    to the root rank using Gatherv of each variable as a fixed-dtype buffer,
+    carrying the depths, temps, sals and i, j indices of the closest 
+    grid-point. MPI counts are 32-bit integers, so the rows held by all 
+    ranks times the number of levels must not exceed 2**31 - 1 values in
+    any variable. Returns the combined profiles on the root rank and None 
+    on all other ranks.
+    
+    """
+    rank = comm.Get_rank()
+    idx = np.where(nearest_rank(comm, synthetic['dists']) == rank)[0]
+    counts = np.empty(comm.Get_size(), dtype=np.int64)
+    comm.Allgather(np.array([len(idx)], dtype=np.int64), counts)
+    displs = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    
+    names = sorted(synthetic)
+    rows = [('idx', idx)] + [(name, synthetic[name][idx]) for name in names]
+    
+    for name, dat in rows:
+        if counts.sum() * int(np.prod(dat.shape[1:])) > np.iinfo(np.int32).max:
+            raise ValueError('Too many values to gather for %s' % name)
+    
+    gathered = {}
+    
+    for n, (name, dat) in enumerate(rows):
+        dat = np.ascontiguousarray(dat)
+        recvbuf = None
         
-        tools.rmfile(config.get('synth_profiles', 'file_name'))
+        if rank == root:
+            width = int(np.prod(dat.shape[1:]))
+            gathered[name] = np.empty((counts.sum(),) + dat.shape[1:], dtype=dat.dtype)
+            recvbuf = [gathered[name], ([int(c) for c in counts * width], 
+                                        [int(d) for d in displs * width])]
             
-    synthDatFinal.write_sals(synthDatFinal.sals)
-    synthDatFinal.write_temps(synthDatFinal.temps)
-    synthDatFinal.write_depths(synthDatFinal.depths)
-    synthDatFinal.write_dist(synthDatFinal.dists)
+        comm.Gatherv(dat, recvbuf, root=root)
+        printmsg.combining(config, n + 1, len(rows))
+    
+    if rank != root:
+        return None
+    
+    combined = synthetic
+    
+    for name in names:
+        combined[name][gathered['idx']] = gathered[name]
+    
+    return combined
 
 
-def update_fpattern(config, section, oldsuffix='.nc', newsuffix='_suffix.nc'):
+def use_parallel_output(config):
     """
-    Update file path used to create synthetic profiles
-    to include rank of process.
+    Return True if synthetic profiles should be written directly by 
+    each rank using parallel netCDF. Falls back to combining profiles 
+    on rank 0 if netCDF4 does not support parallel I/O.
     
     """
-    fpattern = config.get(section, 'fpattern')
-    fpattern = fpattern.replace(oldsuffix, newsuffix)
-    config.set(section, 'fpattern', value=fpattern)
+    if not config.getboolean('parallel', 'parallel_output'):
+        return False
     
-    return config
+    if not datasets.has_parallel_support():
+        printmsg.message(config, 'WARNING: netCDF4 does not support parallel I/O. '
+                                 'Synthetic profiles will be combined on rank 0.')
+        return False
+    
+    return True
+    
+
+def owned_rows(comm, synthetic, root=0):
+    """
+    Return indices of the rows written by this rank when using parallel 
+    output. Each rank writes the observations it holds, and the root rank 
+    also writes observations that are not held by any rank.
+    
+    """
+    held = (synthetic['dists'] < 1e20).astype(np.int32)
+    nheld = np.empty_like(held)
+    comm.Allreduce(held, nheld, op=MPI.SUM)
+    
+    if comm.Get_rank() == root:
+        held[nheld == 0] = 1
+        
+    return np.where(held)[0]
     
 
 def check_ncores(config, size):
@@ -69,24 +214,94 @@ def check_ncores(config, size):
         raise ValueError('Number of MPI cores != nxcores * nycores')
     
 
-def update_ij_range(config, rank):
-    """ Update model imin/imax and jmin/jmax for the specified core"""
+def decompose(args, config, comm):
+    """
+    Return maps of imin, imax, jmin, jmax relative to the model ij range 
+    for each rank. The regular decomposition splits the ij range into
+    nxcores * nycores equal tiles. The balanced decomposition bisects 
+    the ij range using the land mask and observed locations so that
+    any number of ranks hold an approximately equal load.
+    
+    """
+    size = comm.Get_size()
+    method = config.get('parallel', 'decomposition')
+    
+    if method == 'regular':
+        check_ncores(config, size)
+        nxcores = config.getint('parallel', 'nxcores')
+        nycores = config.getint('parallel', 'nycores')
+        ni, nj = ij_shape(config, 'model_temp')
+        tiles = tools.mapcores(ni, nj, nxcores, nycores)
+    elif method == 'balanced':
+        tiles = None
+        if comm.Get_rank() == 0:
+            weights, ocean, nobs = load_weights(args, config)
+            tiles = tools.bisect_cores(weights, size)
+            printmsg.load_report(config, tiles, weights, ocean, nobs)
+        tiles = comm.bcast(tiles, root=0)
+    else:
+        raise ValueError('Decomposition method not recognized: %s' % method)
+    
+    return tiles
+
+
+def ij_shape(config, data_type):
+    """ Return number of grid-points in model ij range along x and y """
+    ni = config.getint(data_type, 'imax') - config.getint(data_type, 'imin') + 1
+    nj = config.getint(data_type, 'jmax') - config.getint(data_type, 'jmin') + 1
+    
+    return ni, nj
+    
+
+def load_weights(args, config, binsize=1.):
+    """
+    Return estimated cost of each model grid-point within the ij range
+    with dimensions [y, x], together with the number of ocean points and 
+    the estimated number of observations at each grid-point. Observations
+    are counted in regular lat/lon bins and shared between ocean points 
+    in the same bin. Each observation costs obs_weight ocean points.
+    
+    """
+    config = tools.build_file_name(args, config, 'obs_profiles')
+    config = tools.build_file_name(args, config, 'model_temp')
+    grid = model.GridGeometry(config, 'model_temp')
+    obsDat = profiles.assoc_profiles(config, 'obs_profiles', preload_data=False)
+    obsDat.load_lats()
+    obsDat.load_lons()
+    
+    ocean = grid.lats < 1e20
+    nlon = int(round(360. / binsize))
+    jbins, ibins = latlon_bins(grid.lats[ocean], grid.lons[ocean], binsize=binsize)
+    mdl_bins = jbins * nlon + ibins
+    jbins, ibins = latlon_bins(np.ma.filled(obsDat.lats, 0), 
+                               np.ma.filled(obsDat.lons, 0), binsize=binsize)
+    obs_bins = jbins * nlon + ibins
+    
+    nbins = int(round(180. / binsize)) * nlon
+    nocean_bin = np.bincount(mdl_bins, minlength=nbins)
+    nobs_bin = np.bincount(obs_bins, minlength=nbins)
+    
+    nobs = np.zeros(ocean.shape)
+    nobs[ocean] = nobs_bin[mdl_bins] / nocean_bin[mdl_bins].astype(float)
+    weights = ocean + config.getfloat('parallel', 'obs_weight') * nobs
+    
+    return weights, ocean, nobs
+    
 
-    nxcores= config.getint('parallel', 'nxcores')
-    nycores= config.getint('parallel', 'nycores')
+def update_ij_range(config, rank, tiles):
+    """ 
+    Update model imin/imax and jmin/jmax for the specified core
+    using maps of imin, imax, jmin, jmax returned by <decompose>.
+    
+    """
+    imins, imaxs, jmins, jmaxs = tiles
 
     for data_type in ['model_temp', 'model_sal']:
         imin = config.getint(data_type, 'imin')
-        imax = config.getint(data_type, 'imax')
         jmin = config.getint(data_type, 'jmin')
-        jmax = config.getint(data_type, 'jmax')
-        
-        ni = imax - imin + 1
-        nj = jmax - jmin + 1
-        imins, imaxs, jmins, jmaxs = tools.mapcores(ni, nj, nxcores, nycores)
-        config.set(data_type, 'imin', value='%i' % imins[rank])
-        config.set(data_type, 'imax', value='%i' % imaxs[rank])
-        config.set(data_type, 'jmin', value='%i' % jmins[rank])
-        config.set(data_type, 'jmax', value='%i' % jmaxs[rank])
+        config.set(data_type, 'imin', value='%i' % (imin + imins[rank]))
+        config.set(data_type, 'imax', value='%i' % (imin + imaxs[rank]))
+        config.set(data_type, 'jmin', value='%i' % (jmin + jmins[rank]))
+        config.set(data_type, 'jmax', value='%i' % (jmin + jmaxs[rank]))
         
     return
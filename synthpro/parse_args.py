@@ -21,6 +21,34 @@ def get_args():
         'namelist', type=str, help='Path to namelist.ini')
     parser.add_argument(
         '-d', '--day', type=int, help='Day used in file names.', default=None)
+    parser.add_argument(
+        '--resume', action='store_true', 
+        help='Resume interrupted run from last checkpoint in output file.')
+    args = parser.parse_args()
+
+    return args
+
+
+def get_batch_args():
+    """
+    Get arguments for a batch of months from command line.
+    
+    """
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic profiles for a range of months.')
+    parser.add_argument(
+        'start_month', type=int, help='First month used in file names.')
+    parser.add_argument(
+        'start_year', type=int, help='First year used in file names.')
+    parser.add_argument(
+        'end_month', type=int, help='Last month used in file names.')
+    parser.add_argument(
+        'end_year', type=int, help='Last year used in file names.')
+    parser.add_argument(
+        'namelist', type=str, help='Path to namelist.ini')
+    parser.add_argument(
+        '--resume', action='store_true', 
+        help='Skip completed months and resume interrupted months from last checkpoint.')
     args = parser.parse_args()
 
     return args
@@ -21,11 +21,31 @@ def extracting(config, n, nmax):
     if config.getboolean('options', 'print_stdout'):
         tools.print_progress('Extracting synthetic data', nmax, n)
     
+def streaming(config, rows, nmax):
+    """ Print range of observations in chunk being processed """
+    if config.getboolean('options', 'print_stdout'):
+        print '\nProcessing profiles %i-%i of %i' % (rows.start + 1, rows.stop, nmax)
+    
 def combining(config, n, nmax):
     """ Print progress bar for combining synthetic profiles"""
     if config.getboolean('options', 'print_stdout'):
         tools.print_progress('Combining synthetic data', nmax, n)
     
+def load_report(config, tiles, weights, ocean, nobs):
+    """ Print ij range, ocean points, observations and load of each core """
+    if config.getboolean('options', 'print_stdout'):
+        imins, imaxs, jmins, jmaxs = tiles
+        loads = []
+        print '\nDomain decomposition (relative to model ij range):'
+        print '  core      i range      j range   ocean pts   obs   load'
+        for n in range(len(imins)):
+            region = (slice(jmins[n], jmaxs[n] + 1), slice(imins[n], imaxs[n] + 1))
+            loads.append(weights[region].sum())
+            print '%6i %6i-%-6i %6i-%-6i %9i %5i %6.0f' % (
+                n, imins[n], imaxs[n], jmins[n], jmaxs[n], 
+                ocean[region].sum(), round(nobs[region].sum()), loads[-1])
+        print 'Load imbalance (max/mean): %.2f\n' % (max(loads) / (sum(loads) / len(loads)))
+
 def writing(config):
     """ Print progress bar for extraction of data"""
     if config.getboolean('options', 'print_stdout'): 
@@ -50,6 +70,17 @@ def inputs(config):
         print 'Input model S data: ' + config.get('model_sal', 'file_name')
         print 'Synthetic profile data: ' + config.get('synth_profiles', 'file_name')+ '\n'
 
+def resuming(config, start, nmax):
+    """ Print resumed output file and first profile to extract """
+    if config.getboolean('options', 'print_stdout'):
+        print '\nResuming output file: %s from profile %i of %i\n' % (
+            config.get('synth_profiles', 'file_name'), start + 1, nmax)
+
+def complete(config):
+    """ Print message for output file that is already complete """
+    if config.getboolean('options', 'print_stdout'):
+        print '\nOutput file is already complete: ' + config.get('synth_profiles', 'file_name') + '\n'
+
 def outputs(config):
     """ Print outputs """
     if config.getboolean('options', 'print_stdout'):        
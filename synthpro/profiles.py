@@ -3,10 +3,21 @@ Data classes for profile data.
 
 """
 
-from netCDF4 import Dataset
-import shutil
 import numpy as np
 
+import datasets
+import tools
+
+
+# Fill value for integer i, j indices
+INDEX_FILL = -99999
+
+# Fill value for temperatures and salinities packed as 16-bit integers
+PACK_FILL = -32768
+
+# Storage options for output written by independent MPI ranks
+NO_FILTERS = {'zlib': False, 'shuffle': False, 'fletcher32': False}
+
 
 class ShapeError(Exception):
     pass
@@ -20,17 +31,22 @@ class Profiles(object):
     netcdf files containing observed profile data
     
     """
-    def __init__(self, config, profile_type='obs_profiles', preload_data=True):
+    mode = 'r'
+    
+    def __init__(self, config, profile_type='obs_profiles', preload_data=True, rows=None):
         """
-        Initialize Profile class using configuration options
+        Initialize Profile class using configuration options. If rows
+        are specified as a slice, only those profiles are read.
         
         """
-        self.f = config.get(profile_type, 'file_name')        
+        self.f = config.get(profile_type, 'file_name')
+        self.rows = rows
         self.temp_var = config.get(profile_type, 'temp_var')
         self.sal_var = config.get(profile_type, 'sal_var')
         self.depth_var = config.get(profile_type, 'depth_var')
         self.lat_var = config.get(profile_type, 'lat_var')
         self.lon_var = config.get(profile_type, 'lon_var')
+        self.dtype = tools.data_dtype(config)
               
         if preload_data:
             self.load_temps()
@@ -40,20 +56,36 @@ class Profiles(object):
             self.load_lons()
             
     def read_var(self, ncvar):
-        """ Read data from specified variable """
-        ncf = Dataset(self.f)
-        dat = ncf.variables[ncvar][:]
-        ncf.close()
+        """ Read data from specified variable for selected rows """
+        rows = slice(None) if self.rows is None else self.rows
+        
+        with datasets.open_dataset(self.f, self.mode) as ncf:
+            dat = ncf.variables[ncvar][rows]
         return dat   
+    
+    def read_data(self, ncvar):
+        """ Read temperature or salinity data in the configured precision """
+        dat = self.read_var(ncvar)
+        
+        if self.dtype is not None:
+            dat = np.ma.asarray(dat, dtype=self.dtype)
+            
+        return dat
+    
+    def count(self):
+        """ Return total number of profiles in file """
+        with datasets.open_dataset(self.f, self.mode) as ncf:
+            nprof = ncf.variables[self.lat_var].shape[0]
+        return nprof
                        
     def load_temps(self):
         """ Load temperatures as <np.array> with dimensions [n, z] """
-        self.temps = self.read_var(self.temp_var)
+        self.temps = self.read_data(self.temp_var)
         self.test_shape(self.temp_var, self.temps.shape, 2)
         
     def load_sals(self):
         """ Load salinities as <np.array> with dimensions [n, z] """
-        self.sals = self.read_var(self.sal_var)
+        self.sals = self.read_data(self.sal_var)
         self.test_shape(self.sal_var, self.sals.shape, 2)
         
     def load_depths(self):
@@ -71,6 +103,18 @@ class Profiles(object):
         self.lons = self.read_var(self.lon_var)
         self.test_shape(self.lon_var, self.lons.shape, 1)
         
+    def max_depth(self):
+        """ 
+        Return deepest depth with a valid temperature or salinity, or 
+        NaN if there are no valid observations.
+        
+        """
+        valid = ~(np.ma.getmaskarray(self.temps) & np.ma.getmaskarray(self.sals))
+        depths = tools.fill_nan(self.depths, dtype=np.float64)[valid]
+        depths = depths[~np.isnan(depths)]
+        
+        return depths.max() if len(depths) > 0 else np.nan
+        
     def test_shape(self, varname, varshape, ndim):
         if len(varshape) != ndim:
             raise ShapeError('Shape=%s. Expected %i-D array for %s' %
@@ -83,17 +127,26 @@ class SynthProfiles(Profiles):
     synthetic data to file.
     
     """
-    def __init__(self, config, profile_type='synth_profiles', preload_data=True, read_only=False):
+    def __init__(self, config, profile_type='synth_profiles', preload_data=False, 
+                 read_only=False, rows=None):
         """ Extend __init__ method for SynthProfile class. """
         
-        Profiles.__init__(self, config, profile_type=profile_type, preload_data=preload_data)
+        self.mode = 'r' if read_only else 'r+'
+        self.unfiltered = parallel_output(config)
+        Profiles.__init__(self, config, profile_type=profile_type, 
+                          preload_data=preload_data, rows=rows)
         self.dist_var = 'distance_to_ob'
         self.i_var = 'i_index'
         self.j_var = 'j_index'
 
         if not read_only:
-            for synthvar in [self.dist_var, self.i_var, self.j_var]:
-                self.duplicate_var(self.lat_var, synthvar)
+            if not self.has_var(self.dist_var):
+                self.duplicate_var(self.lat_var, self.dist_var)
+                
+            for synthvar in [self.i_var, self.j_var]:
+                if not self.has_var(synthvar):
+                    self.duplicate_var(self.lat_var, synthvar, 
+                                       dtype='i4', fill_value=INDEX_FILL)
 
     def load_dists(self):
         """ Load distances as <np.array> with dimensions [n] """
@@ -101,53 +154,83 @@ class SynthProfiles(Profiles):
         self.test_shape(self.dist_var, self.dists.shape, 1)
         
     def load_i(self):
-        """ Load i indices as <np.array> with dimensions [n] """
-        self.i = self.read_var(self.i_var)
+        """ Load i indices as <np.array> with dimensions [n] and NaN if missing """
+        self.i = self.read_index(self.i_var)
         self.test_shape(self.i_var, self.i.shape, 1)
 
     def load_j(self):
-        """ Load j indices as <np.array> with dimensions [n] """
-        self.j = self.read_var(self.j_var)
+        """ Load j indices as <np.array> with dimensions [n] and NaN if missing """
+        self.j = self.read_index(self.j_var)
         self.test_shape(self.j_var, self.j.shape, 1)
+        
+    def read_index(self, ncvar):
+        """ Read integer or float index variable as floats with NaN if missing """
+        return np.ma.filled(np.ma.asarray(self.read_var(ncvar), dtype=np.float64), np.nan)
 
-    def write_var(self, ncvar, dat):
-        """ Write data to specified variable """#
-        ncf = Dataset(self.f, 'r+')
-        var = ncf.variables[ncvar]
-        var[:] = dat
-        ncf.close()
+    def write_var(self, ncvar, dat, rows=None, start=0):
+        """ 
+        Write data to specified variable beginning at row start. If 
+        rows are specified, only those rows of dat are written in 
+        contiguous blocks. NaN values are written as missing.
         
-    def write_dist(self, dat):
+        """
+        with datasets.open_dataset(self.f, 'r+') as ncf:
+            var = ncf.variables[ncvar]
+            dat = mask_unpackable(var, np.ma.masked_invalid(dat))
+            
+            if rows is None:
+                var[start:start + len(dat)] = dat
+            else:
+                for n0, n1 in tools.contiguous_runs(rows):
+                    var[start + n0:start + n1] = dat[n0:n1]
+        
+    def write_dist(self, dat, **kwargs):
         """ Write distance data to file. """
-        self.write_var(self.dist_var, dat)
+        self.write_var(self.dist_var, dat, **kwargs)
         
-    def write_i(self, dat):
-        """ Write i index to file. """
-        self.write_var(self.i_var, dat)
+    def write_i(self, dat, **kwargs):
+        """ Write i index to file. NaN values are written as missing. """
+        self.write_var(self.i_var, dat, **kwargs)
         
-    def write_j(self, dat):
-        """ Write j index to file. """
-        self.write_var(self.j_var, dat)    
+    def write_j(self, dat, **kwargs):
+        """ Write j index to file. NaN values are written as missing. """
+        self.write_var(self.j_var, dat, **kwargs)    
         
-    def write_depths(self, dat):
+    def write_depths(self, dat, **kwargs):
         """ Write depth data to file. """
-        self.write_var(self.depth_var, dat)
+        self.write_var(self.depth_var, dat, **kwargs)
                 
-    def write_temps(self, dat):
+    def write_temps(self, dat, **kwargs):
         """ Write depth data to file. """
-        self.write_var(self.temp_var, dat)
+        self.write_var(self.temp_var, dat, **kwargs)
     
-    def write_sals(self, dat):
+    def write_sals(self, dat, **kwargs):
         """ Write depth data to file. """
-        self.write_var(self.sal_var, dat)
-
-    def duplicate_var(self, ncvar1, ncvar2):
-        """ Create new variable based on existing variable """
-        ncf = Dataset(self.f, 'r+')
-        var1 = ncf.variables[ncvar1]
-        ncf.createVariable(ncvar2, var1.dtype, dimensions=var1.dimensions,
-                           fill_value=1e20)
-        ncf.close()
+        self.write_var(self.sal_var, dat, **kwargs)
+        
+    def has_var(self, ncvar):
+        """ Return True if variable exists in file """
+        with datasets.open_dataset(self.f, self.mode) as ncf:
+            exists = ncvar in ncf.variables
+        return exists
+
+    def duplicate_var(self, ncvar1, ncvar2, dtype=None, fill_value=1e20):
+        """ 
+        Create new variable with the dimensions, compression and 
+        chunking of an existing variable. Filters are not used with 
+        parallel output.
+        
+        """
+        with datasets.open_dataset(self.f, 'r+') as ncf:
+            var1 = ncf.variables[ncvar1]
+            dtype = var1.dtype if dtype is None else dtype
+            kwargs = storage_options(var1)
+            
+            if self.unfiltered:
+                kwargs.update(NO_FILTERS)
+                
+            ncf.createVariable(ncvar2, dtype, dimensions=var1.dimensions,
+                               fill_value=fill_value, **kwargs)
       
 
 
@@ -178,14 +261,230 @@ def assoc_profiles(config, profile_type, **kwargs):
     
     return proDat
 
+
+def max_obs_depth(config, start=0, chunk_size=10000):
+    """ 
+    Return deepest valid observed depth from profile start onwards, or 
+    NaN if there are no valid depths. Only the depth variable is read, 
+    chunk_size observed profiles at a time, so depths without a valid 
+    temperature or salinity are included.
+    
+    """
+    nmax = assoc_profiles(config, 'obs_profiles', preload_data=False).count()
+    deepest = np.nan
+    
+    for rows in tools.chunk_slices(nmax, chunk_size, start=start):
+        obsDat = assoc_profiles(config, 'obs_profiles', preload_data=False, rows=rows)
+        obsDat.load_depths()
+        depths = tools.fill_nan(obsDat.depths, dtype=np.float64)
+        depths = depths[~np.isnan(depths)]
+        
+        if len(depths) > 0:
+            deepest = np.nanmax([deepest, depths.max()])
+    
+    return deepest
+
  
-def create_synth_file(config):
+def create_synth_file(config, chunk_size=10000):
     """
-    Create a copy of netcdf containing observed profiles
-    to hold synthetic profiles.
+    Create netcdf file to hold synthetic profiles using the dimensions,
+    attributes and variables of the file containing observed profiles. 
+    Data are copied for all variables except the temperature, salinity 
+    and depth variables that are replaced by synthetic profiles, which
+    are left empty. Variables are copied in blocks of chunk_size rows. 
+    Compression, chunking and packing are set by [output] options.
     
     """
     obsf = config.get('obs_profiles', 'file_name')
     synthf = config.get('synth_profiles', 'file_name')
-    shutil.copy(obsf, synthf)
+    replaced = [config.get('synth_profiles', opt) for opt in 
+                ['temp_var', 'sal_var', 'depth_var']]
+    packed = [config.get('synth_profiles', opt) for opt in ['temp_var', 'sal_var']]
+    datasets.close(synthf)
+    
+    compress = use_compression(config)
+    
+    with datasets.open_dataset(obsf) as ncin:
+        fmt = output_format(ncin.data_model, compress)
+        prof_var = ncin.variables[config.get('obs_profiles', 'lat_var')]
+        nprof, prof_dim = prof_var.shape[0], prof_var.dimensions[0]
+        
+        with datasets.open_dataset(synthf, 'w', format=fmt) as ncout:
+            ncout.setncatts(dict((att, ncin.getncattr(att)) for att in ncin.ncattrs()))
+            
+            for name, dim in ncin.dimensions.items():
+                ncout.createDimension(name, None if dim.isunlimited() else len(dim))
+                
+            for name, var in ncin.variables.items():
+                if fmt.startswith('NETCDF4'):
+                    kwargs = output_storage(config, ncin, var, prof_dim, nprof, compress)
+                else:
+                    kwargs = {}
+                    
+                if (name in packed) and config.getboolean('output', 'pack_data'):
+                    kwargs.update(datatype='i2', fill_value=PACK_FILL, 
+                                  attrs=pack_attrs(config, var))
+                    
+                copy_var(var, ncout, copy_data=(name not in replaced), 
+                         chunk_size=chunk_size, **kwargs)
+    
+    datasets.close(synthf)
+
+
+def output_format(data_model, compress):
+    """ 
+    Return netcdf format of output file. Files are written in the 
+    format of the observed profiles unless compression requires
+    conversion from a netCDF3 format to NETCDF4_CLASSIC.
+    
+    """
+    if compress and data_model.startswith('NETCDF3'):
+        return 'NETCDF4_CLASSIC'
+    
+    return data_model
 
+
+def use_compression(config):
+    """ 
+    Return True if output should be compressed. Compression is not 
+    used with parallel output, which does not support compressed 
+    writes from independent ranks.
+    
+    """
+    if not config.getboolean('output', 'zlib'):
+        return False
+    
+    if parallel_output(config):
+        print 'WARNING: Compression is not supported with parallel_output. Output will not be compressed.'
+        return False
+    
+    return True
+
+
+def parallel_output(config):
+    """ Return True if output file is written by independent MPI ranks """
+    return (config.getboolean('parallel', 'parallel_output') and 
+            config.getboolean('parallel', 'submit_parallel'))
+    
+
+def output_storage(config, ncin, var, prof_dim, nprof, compress):
+    """ 
+    Return compression and chunking settings for variable in netCDF4 
+    output file. Variables with a profile dimension are chunked by
+    profile_chunk_size profiles with all levels in each chunk. Filters
+    of the observed variable are not copied with parallel output.
+    
+    """
+    if compress and (var.dtype != str):
+        kwargs = {'zlib': True, 
+                  'complevel': config.getint('output', 'complevel'),
+                  'shuffle': config.getboolean('output', 'shuffle')}
+    else:
+        kwargs = storage_options(var)
+        
+    if parallel_output(config):
+        kwargs.update(NO_FILTERS)
+        
+    chunk_profiles = config.getint('output', 'profile_chunk_size')
+    
+    if (chunk_profiles > 0) and (len(var.dimensions) > 0) and (var.dimensions[0] == prof_dim):
+        kwargs['chunksizes'] = [max(min(chunk_profiles, nprof), 1)] + [
+            max(len(ncin.dimensions[dim]), 1) for dim in var.dimensions[1:]]
+    
+    return kwargs
+            
+
+def storage_options(var):
+    """ Return compression and chunking settings of netcdf variable """
+    kwargs = {}
+    
+    filters = var.filters()
+    if filters is not None:
+        kwargs.update(zlib=filters.get('zlib', False), shuffle=filters.get('shuffle', False),
+                      complevel=filters.get('complevel', 4), 
+                      fletcher32=filters.get('fletcher32', False))
+    
+    chunks = var.chunking()
+    if chunks not in (None, 'contiguous'):
+        kwargs['chunksizes'] = chunks
+        
+    return kwargs
+
+
+def pack_attrs(config, var):
+    """ 
+    Return attributes of variable packed as 16-bit integers. Valid
+    limits are compared with packed values by netcdf readers, so they
+    are converted to packed units and limited to the packed range.
+    
+    """
+    scale = config.getfloat('output', 'pack_scale')
+    offset = config.getfloat('output', 'pack_offset')
+    attrs = {'scale_factor': scale, 'add_offset': offset}
+    
+    for att in ['valid_min', 'valid_max', 'valid_range']:
+        if att in var.ncattrs():
+            packed = np.round((np.asarray(var.getncattr(att), dtype=np.float64) - offset) / scale)
+            attrs[att] = np.clip(packed, PACK_FILL + 1, np.iinfo(np.int16).max).astype(np.int16)
+            
+    return attrs
+
+
+def mask_unpackable(var, dat):
+    """ 
+    Return data with values that cannot be stored in variable packed 
+    as 16-bit integers masked. A warning is printed if any are found.
+    
+    """
+    if (var.dtype != np.int16) or ('scale_factor' not in var.ncattrs()):
+        return dat
+    
+    scale = var.getncattr('scale_factor')
+    offset = var.getncattr('add_offset') if 'add_offset' in var.ncattrs() else 0.
+    dat = np.ma.asarray(dat)
+    
+    with np.errstate(invalid='ignore'):
+        invalid = np.ma.filled((dat < offset + scale * (PACK_FILL + 1)) | 
+                               (dat > offset + scale * np.iinfo(np.int16).max), False)
+    
+    if invalid.any():
+        print 'WARNING: %i values outside packed range of %s are written as missing' % (
+            invalid.sum(), var.name)
+        dat = np.ma.masked_where(invalid, dat)
+        
+    return dat
+                
+
+def copy_var(var, ncout, copy_data=True, chunk_size=10000, datatype=None, 
+             fill_value=None, attrs=None, **kwargs):
+    """ 
+    Create copy of netcdf variable in ncout with the same attributes.
+    Datatype, fill value and attributes can be overridden, and keyword 
+    arguments set compression and chunking. If copy_data is True, raw 
+    data are copied in blocks of chunk_size along the first dimension.
+    
+    """
+    var_attrs = dict((att, var.getncattr(att)) for att in var.ncattrs())
+    var_fill = var_attrs.pop('_FillValue', None)
+    var_attrs.update({} if attrs is None else attrs)
+    
+    out = ncout.createVariable(var.name, var.datatype if datatype is None else datatype,
+                               var.dimensions, 
+                               fill_value=var_fill if fill_value is None else fill_value, 
+                               **kwargs)
+    out.setncatts(var_attrs)
+    
+    if not copy_data:
+        return
+    
+    var.set_auto_maskandscale(False)
+    out.set_auto_maskandscale(False)
+    
+    try:
+        if len(var.shape) == 0:
+            out.assignValue(var.getValue())
+        else:
+            for rows in tools.chunk_slices(var.shape[0], chunk_size):
+                out[rows] = var[rows]
+    finally:
+        var.set_auto_maskandscale(True)
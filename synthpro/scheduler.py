@@ -0,0 +1,94 @@
+"""
+Routines to extract synthetic profiles under openMPI using dynamic
+scheduling. Rank 0 hands out chunks of observations on demand to
+worker ranks that hold the model data and spatial index.
+
+"""
+
+import extract
+import printmsg
+import tools
+import checkpoint
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    pass
+
+
+# Message tags
+TAG_RESULT = 1
+TAG_CHUNK = 2
+
+
+class ObsChunk(object):
+    """
+    Class holding observed profiles for a contiguous chunk of rows
+    of a <Profiles> object that are sent to worker ranks.
+
+    """
+    def __init__(self, obsDat, rows):
+        """ Initialize <ObsChunk> for rows given as a slice """
+        self.rows = rows
+        self.lats = obsDat.lats[rows]
+        self.lons = obsDat.lons[rows]
+        self.depths = obsDat.depths[rows]
+        self.temps = obsDat.temps[rows]
+        self.sals = obsDat.sals[rows]
+
+
+def master(config, comm, obsDat, synthDat, start=0):
+    """
+    Hand out chunks of obs_chunk_size observations, beginning at 
+    profile start, to worker ranks as they become idle. The synthetic 
+    profiles returned for each chunk are written to synthDat and 
+    checkpointed as they arrive.
+
+    """
+    nworkers = comm.Get_size() - 1
+
+    if nworkers < 1:
+        raise ValueError('Dynamic scheduling requires at least two MPI ranks')
+
+    chunk_size = config.getint('parallel', 'obs_chunk_size')
+    nmax = len(obsDat.lats)
+    chunks = tools.chunk_slices(nmax, chunk_size, start=start)
+    chunks.reverse()
+
+    progress = checkpoint.Progress(config, ndone=start)
+    status = MPI.Status()
+    ndone = start
+
+    while nworkers > 0:
+        result = comm.recv(source=MPI.ANY_SOURCE, tag=TAG_RESULT, status=status)
+
+        if result is not None:
+            rows, chunk_synthetic = result
+            extract.write_profiles(config, synthDat, chunk_synthetic, start=rows.start)
+            progress.update(rows)
+            ndone += rows.stop - rows.start
+            printmsg.extracting(config, ndone, nmax)
+
+        if chunks:
+            comm.send(ObsChunk(obsDat, chunks.pop()), dest=status.Get_source(), tag=TAG_CHUNK)
+        else:
+            comm.send(None, dest=status.Get_source(), tag=TAG_CHUNK)
+            nworkers -= 1
+
+
+def worker(config, comm, modelTemp, modelSal):
+    """
+    Request chunks of observations from rank 0, extract synthetic
+    profiles and return them until no chunks remain.
+
+    """
+    result = None
+
+    while True:
+        comm.send(result, dest=0, tag=TAG_RESULT)
+        chunk = comm.recv(source=0, tag=TAG_CHUNK)
+
+        if chunk is None:
+            break
+
+        result = (chunk.rows, extract.extract_profiles(config, chunk, modelTemp, modelSal))
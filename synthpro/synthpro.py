@@ -3,6 +3,8 @@ Module containing main routines to execute SynthPro.
 
 """
 
+from multiprocessing.pool import ThreadPool
+
 import parse_args
 import namelist
 import numpy as np
@@ -13,6 +15,10 @@ import extract
 import tools
 import printmsg
 import para
+import datasets
+import scheduler
+import checkpoint
+import colstore
 
 try:
     from mpi4py import MPI
@@ -20,30 +26,236 @@ except ImportError:
     print 'WARNING: mpi4py not available. Parallel jobs will fail.'
     
 
-def main_singlenode(args, config):
-    """ Run a single instance of SynthPro """
+# Number of observed profiles extracted between checkpoints of runs 
+# using --resume when stream_chunk_size is not set
+RESUME_CHUNK_SIZE = 10000
+
+
+def main_singlenode(args, config, comm=None):
+    """ 
+    Run a single instance of SynthPro. If an MPI communicator is 
+    provided, only observations within the tile of this rank are used
+    and synthetic profiles are combined and written by rank 0. With 
+    dynamic scheduling, rank 0 instead hands out observations to the 
+    other ranks. If streaming is enabled, observations are processed
+    in chunks of stream_chunk_size profiles. Resumed runs only extract
+    profiles after the last checkpoint in the synthetic profile file,
+    and are always processed in chunks so that they are checkpointed
+    as each chunk is written.
+    
+    """
+    rank = 0 if comm is None else comm.Get_rank()
+    dynamic = (comm is not None) and (config.get('parallel', 'scheduling') == 'dynamic')
     printmsg.start(args, config)
     
     # Build paths to input data files
+    config = build_file_names(args, config)
+    printmsg.inputs(config) 
+    
+    # Find first profile to extract
+    start, nmax = resume_point(args, config, comm=comm)
+    
+    if not dynamic:
+        config = resume_streaming(args, config)
+    
+    if (start > 0) and (start >= nmax):
+        printmsg.complete(config)
+        return
+
+    # Create file to store synthetic profiles
+    if rank == 0:
+        if start == 0:
+            profiles.create_synth_file(config)
+            printmsg.outputs(config)
+        else:
+            printmsg.resuming(config, start, nmax)
+
+    # Open each file once for all reads and writes
+    datasets.configure(config)
+    
+    with datasets.session():
+    
+        printmsg.loading(config)
+        
+        if dynamic:
+            extract_dynamic(config, comm, start=start)
+            return
+        
+        if use_streaming(config):
+            extract_streaming(config, start, nmax, comm=comm)
+            return
+        
+        # Load data objects     
+        obsDat = profiles.assoc_profiles(config, 'obs_profiles', rows=slice(start, nmax))
+        max_depth = obsDat.max_depth()
+        modelTemp, modelSal = model.assoc_models(config, max_depth=max_depth)
+    
+        # Extract profiles
+        synthetic = extract.extract_profiles(config, obsDat, modelTemp, modelSal, 
+                                             comm=comm)
+        
+        # Write profiles
+        printmsg.writing(config)
+        write_profiles(config, synthetic, comm=comm, start=start)
+        
+        if rank == 0:
+            checkpoint.Progress(config, ndone=start).update(slice(start, nmax))
+
+
+def resume_point(args, config, comm=None):
+    """ 
+    Return first profile to extract and total number of observed 
+    profiles. Under MPI, these are found by rank 0 and broadcast.
+    
+    """
+    if (comm is None) or (comm.Get_rank() == 0):
+        point = (checkpoint.resume_from(args, config), checkpoint.count_profiles(config))
+    else:
+        point = None
+        
+    if comm is not None:
+        point = comm.bcast(point, root=0)
+        
+    return point
+
+
+def build_file_names(args, config):
+    """ Build paths to input and output data files for a single date """
     config = tools.build_file_name(args, config, 'obs_profiles')
     config = tools.build_file_name(args, config, 'synth_profiles')
     config = tools.build_file_name(args, config, 'model_temp')
     config = tools.build_file_name(args, config, 'model_sal') 
-    printmsg.inputs(config) 
+    
+    return config
 
-    # Create file to store synthetic profiles
-    profiles.create_synth_file(config)
-    printmsg.outputs(config)        
 
-    # Load data objects     
-    printmsg.loading(config)
-    obsDat = profiles.assoc_profiles(config, 'obs_profiles')
-    synthDat = profiles.assoc_profiles(config, 'synth_profiles')
-    modelTemp = model.assoc_model(config, 'model_temp')
-    modelSal = model.assoc_model(config, 'model_sal')
+def load_inputs(args, config):
+    """ Load observed and model data for a single date """
+    config = build_file_names(args, config)
+    
+    with datasets.session():
+        obsDat = profiles.assoc_profiles(config, 'obs_profiles')
+        max_depth = obsDat.max_depth()
+        modelTemp, modelSal = model.assoc_models(config, max_depth=max_depth)
+    
+    return config, obsDat, modelTemp, modelSal
+
+
+def save_profiles(config, synthetic):
+    """ Create output file and write synthetic profiles for a single date """
+    with datasets.session():
+        profiles.create_synth_file(config)
+        printmsg.outputs(config)
+        printmsg.writing(config)
+        write_profiles(config, synthetic)
+        checkpoint.Progress(config).update(slice(0, len(synthetic['dists'])))
+    
+
+def extract_dynamic(config, comm, start=0):
+    """
+    Extract profiles using dynamic scheduling of observation chunks.
+    Rank 0 loads the observations and writes synthetic profiles as each
+    chunk is returned while other ranks load the model data and extract 
+    profiles on demand. Chunks before profile start are skipped. The
+    deepest observed depth is found by rank 0 and broadcast.
+    
+    """
+    if comm.Get_rank() == 0:
+        obsDat = profiles.assoc_profiles(config, 'obs_profiles')
+        comm.bcast(obsDat.max_depth(), root=0)
+        synthDat = profiles.assoc_profiles(config, 'synth_profiles', preload_data=False)
+        printmsg.writing(config)
+        scheduler.master(config, comm, obsDat, synthDat, start=start)
+    else:
+        max_depth = comm.bcast(None, root=0)
+        modelTemp, modelSal = model.assoc_models(config, max_depth=max_depth)
+        scheduler.worker(config, comm, modelTemp, modelSal)
+        
+
+def use_streaming(config):
+    """ Return True if observations should be processed in chunks """
+    return config.getint('options', 'stream_chunk_size') > 0
+
+
+def resume_streaming(args, config):
+    """ 
+    Switch on streaming in chunks of RESUME_CHUNK_SIZE profiles for runs
+    using --resume, so that the checkpoint is updated as each chunk is 
+    written rather than once the output file is complete.
+    
+    """
+    if getattr(args, 'resume', False) and not use_streaming(config):
+        config.set('options', 'stream_chunk_size', str(RESUME_CHUNK_SIZE))
+        printmsg.message(config, 'Resumable run: processing profiles in chunks of %i' % 
+                         RESUME_CHUNK_SIZE)
+        
+    return config
+
+
+def extract_streaming(config, start, nmax, comm=None):
+    """
+    Extract and write synthetic profiles for chunks of stream_chunk_size
+    observations in turn, beginning at profile start. Only the observations 
+    in the current chunk are held in memory, and the synthetic profiles for 
+    each chunk are written and checkpointed before the next chunk is read.
+    The deepest observed depth is found by rank 0 and broadcast.
+    
+    """
+    chunk_size = config.getint('options', 'stream_chunk_size')
+    
+    if (comm is None) or (comm.Get_rank() == 0):
+        max_depth = profiles.max_obs_depth(config, start=start, chunk_size=chunk_size)
+    else:
+        max_depth = None
+        
+    if comm is not None:
+        max_depth = comm.bcast(max_depth, root=0)
+        
+    modelTemp, modelSal = model.assoc_models(config, max_depth=max_depth)
+    progress = checkpoint.Progress(config, ndone=start)
+    printmsg.writing(config)
+    
+    for rows in tools.chunk_slices(nmax, chunk_size, start=start):
+        printmsg.streaming(config, rows, nmax)
+        obsDat = profiles.assoc_profiles(config, 'obs_profiles', rows=rows)
+        synthetic = extract.extract_profiles(config, obsDat, modelTemp, modelSal, 
+                                             comm=comm)
+        write_profiles(config, synthetic, comm=comm, start=rows.start)
+        
+        if (comm is None) or (comm.Get_rank() == 0):
+            progress.update(rows)
+        
 
-    # Extract profiles
-    extract.extract_profiles(config, obsDat, synthDat, modelTemp, modelSal)
+def write_profiles(config, synthetic, comm=None, start=0):
+    """
+    Write synthetic profiles to file beginning at row start. Under MPI, 
+    profiles are either written directly by each rank using parallel 
+    netCDF or combined in memory and written by rank 0.
+    
+    """
+    if comm is None:
+        synthDat = profiles.assoc_profiles(config, 'synth_profiles', preload_data=False)
+        extract.write_profiles(config, synthDat, synthetic, start=start)
+        
+    elif para.use_parallel_output(config):
+        if comm.Get_rank() == 0:
+            synthDat = profiles.assoc_profiles(config, 'synth_profiles', preload_data=False)
+            datasets.close(synthDat.f)
+        comm.Barrier()
+        
+        synthDat = profiles.assoc_profiles(config, 'synth_profiles', 
+                                           preload_data=False, read_only=True)
+        rows = para.owned_rows(comm, synthetic)
+        
+        with datasets.parallel_session(synthDat.f, comm):
+            extract.write_profiles(config, synthDat, synthetic, rows=rows, start=start)
+            
+    else:
+        synthetic = para.reduce_profiles(config, comm, synthetic)
+        
+        if comm.Get_rank() == 0:
+            synthDat = profiles.assoc_profiles(config, 'synth_profiles', preload_data=False)
+            extract.write_profiles(config, synthDat, synthetic, start=start)
 
 
 def main_parallel(args, config):
@@ -51,23 +263,31 @@ def main_parallel(args, config):
     
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
-    size = comm.Get_size()
     
-    if rank == 0:
-        para.check_ncores(config, size)
-    else:
+    if rank != 0:
         config.set('options', 'print_stdout', value='False')
+        
+    # Ranks read model data themselves rather than forking worker processes
+    if config.getint('options', 'read_procs') > 1:
+        printmsg.message(config, 'WARNING: read_procs is not used under openMPI. '
+                         'Model data are read by each rank.')
+        config.set('options', 'read_procs', value='1')
     
-    para.update_ij_range(config, rank)
-    config = para.update_fpattern(config, 'synth_profiles',
-                  newsuffix=('_core%i.nc' % rank))
+    if config.get('parallel', 'scheduling') != 'dynamic':
+        tiles = para.decompose(args, config, comm)
+        para.update_ij_range(config, rank, tiles)
+        model.retain_grids(config)
+        
+    main_singlenode(args, config, comm=comm)
 
-    main_singlenode(args, config)
-    comm.Barrier()
-    
-    if rank == 0:
-        para.combine_profiles(args, config, size)
 
+def run(args, config):
+    """ Run synthpro in serial or parallel for a single date """
+    if config.getboolean('parallel', 'submit_parallel'):
+        main_parallel(args, config)
+    else:
+        main_singlenode(args, config)
+        
 
 def main():
     """
@@ -76,16 +296,109 @@ def main():
     """
     args = parse_args.get_args()
     config = namelist.get_namelist(args)
-    
-    if config.getboolean('parallel', 'submit_parallel'):
-        main_parallel(args, config)
-    else:
-        main_singlenode(args, config)
+    run(args, config)
         
     # Finished
     printmsg.finished(config)
-   
+    
+
+def run_pipelined(args, dates):
+    """
+    Run synthpro for each date with reading, extraction and writing
+    overlapped. Input data for the next date are loaded by a background
+    thread while profiles are extracted for the current date, and the
+    output for the previous date is written by a second thread.
+    
+    """
+    config = namelist.get_namelist(args)
+    datasets.configure(config)
+    reader = ThreadPool(1)
+    writer = ThreadPool(1)
+    
+    try:
+        loading = reader.apply_async(load_inputs, (dates[0], config))
+        writing = None
         
- 
+        for ndate, date_args in enumerate(dates):
+            config, obsDat, modelTemp, modelSal = loading.get()
+            
+            if ndate + 1 < len(dates):
+                loading = reader.apply_async(
+                    load_inputs, (dates[ndate + 1], namelist.get_namelist(args)))
+            
+            printmsg.start(date_args, config)
+            printmsg.inputs(config)
+            
+            with datasets.session():
+                synthetic = extract.extract_profiles(config, obsDat, modelTemp, modelSal)
+            
+            if writing is not None:
+                writing.get()
+            writing = writer.apply_async(save_profiles, (config, synthetic))
+            
+        writing.get()
+        reader.close()
+        writer.close()
+    except:
+        reader.terminate()
+        writer.terminate()
+        raise
+    finally:
+        reader.join()
+        writer.join()
+    
+
+def main_batch():
+    """
+    Parse command line arguments and options and run synthpro
+    for each month in a range of dates. Model grid geometry is 
+    shared between months so that only observations and model
+    data are reloaded.
+    
+    """
+    args = parse_args.get_batch_args()
+    config = namelist.get_namelist(args)
+    dates = tools.date_range(args, config)
     
+    if (config.getboolean('options', 'prefetch') and not use_streaming(config) and
+        not config.getboolean('parallel', 'submit_parallel')):
+        if args.resume:
+            dates = [date_args for date_args in dates if not checkpoint.is_complete(
+                date_args, build_file_names(date_args, namelist.get_namelist(args)))]
+        if dates:
+            run_pipelined(args, dates)
+    else:
+        for date_args in dates:
+            config = namelist.get_namelist(args)
+            run(date_args, config)
+        
+    # Finished
+    printmsg.finished(config)
+
 
+def main_store():
+    """
+    Parse command line arguments and options and build the column
+    store of model temperature and salinity for each month in a range 
+    of dates. Store entries that are already up to date are kept.
+    
+    """
+    args = parse_args.get_batch_args()
+    config = namelist.get_namelist(args)
+    columnStore = colstore.ColumnStore(config.get('store', 'store_dir'))
+    
+    for date_args in tools.date_range(args, config):
+        config = build_file_names(date_args, namelist.get_namelist(args))
+        datasets.configure(config)
+        
+        with datasets.session():
+            for data_type in ['model_temp', 'model_sal']:
+                printmsg.message(config, 'Building column store for %s: %s' % 
+                                 (config.get(data_type, 'data_var'), 
+                                  config.get(data_type, 'file_name')))
+                modelDat = model.assoc_model(config, data_type, preload_data=False, 
+                                             read_columns=True, store=columnStore)
+                modelDat.load_stored()
+                
+    # Finished
+    printmsg.finished(config)
@@ -0,0 +1,223 @@
+"""
+Unit tests for classes in model module.
+
+"""
+import unittest
+import threading
+import tempfile
+import shutil
+import os
+import ConfigParser
+import numpy as np
+from netCDF4 import Dataset
+
+import model
+import namelist
+
+
+def make_config(f, maskf, read_procs=1):
+    """ Return configuration options for model data in test files """
+    config = ConfigParser.ConfigParser()
+
+    for data_type in ['model_temp', 'model_sal']:
+        config.add_section(data_type)
+        options = [('file_name', f), ('model_type', 'NEMO'), ('data_var', 'votemper'),
+                   ('maskf', maskf), ('mask_var', 'tmask'), ('mask_mdi', '0'),
+                   ('depth_var', 'deptht'), ('lat_var', 'nav_lat'), ('lon_var', 'nav_lon'),
+                   ('imin', '0'), ('imax', '3'), ('jmin', '0'), ('jmax', '4')]
+        for option, value in options:
+            config.set(data_type, option, value)
+
+    config = namelist.set_defaults(config)
+    config.set('options', 'read_procs', str(read_procs))
+    config.set('options', 'extract_full_depth', 'False')
+    config.set('options', 'print_stdout', 'False')
+
+    return config
+
+
+def make_files(tmpdir):
+    """ 
+    Create compressed model and mask files on a small grid in tmpdir and
+    return their names with the index of the bottom level at each point 
+    
+    """
+    f = os.path.join(tmpdir, 'grid_T.nc')
+    maskf = os.path.join(tmpdir, 'tmask.nc')
+    nz, ny, nx = 9, 5, 4
+    kbottom = np.random.randint(0, nz + 1, (ny, nx))
+    mask = (np.arange(nz)[:, np.newaxis, np.newaxis] < kbottom).astype(np.int8)
+
+    with Dataset(f, 'w') as ncf:
+        ncf.createDimension('deptht', nz)
+        ncf.createDimension('y', ny)
+        ncf.createDimension('x', nx)
+        ncf.createVariable('deptht', 'f4', ('deptht',))[:] = np.arange(nz) * 10. + 5.
+        ncf.createVariable('nav_lat', 'f4', ('y', 'x'))[:] = np.random.rand(ny, nx)
+        ncf.createVariable('nav_lon', 'f4', ('y', 'x'))[:] = np.random.rand(ny, nx)
+        ncf.createVariable('votemper', 'f4', ('deptht', 'y', 'x'), zlib=True)[:] = \
+            np.random.rand(nz, ny, nx)
+
+    with Dataset(maskf, 'w') as ncf:
+        ncf.createDimension('deptht', nz)
+        ncf.createDimension('y', ny)
+        ncf.createDimension('x', nx)
+        ncf.createVariable('tmask', 'i1', ('deptht', 'y', 'x'), zlib=True)[:] = mask
+
+    return f, maskf, kbottom
+
+
+class TestGridRegistry(unittest.TestCase):
+    """ Unit tests for <model.assoc_grid> and <model.grid_key> """
+
+    def setUp(self):
+        """ Create model and mask files """
+        np.random.seed(0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.f, self.maskf, self.kbottom = make_files(self.tmpdir)
+        model.clear_grids()
+
+    def tearDown(self):
+        model.clear_grids()
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_grid(self):
+        """ Test temperature and salinity share one grid """
+        config = make_config(self.f, self.maskf)
+        modelTemp, modelSal = model.assoc_models(config, preload_data=False)
+        self.assertTrue(isinstance(modelTemp.grid, model.GridGeometry))
+        self.assertTrue(modelTemp.grid is modelSal.grid)
+        self.assertEqual(model.grid_key(config, 'model_temp'), 
+                         model.grid_key(config, 'model_sal'))
+        self.assertEqual(len(model._grids), 1)
+
+    def test_ij_range(self):
+        """ Test a different ij range gives a new grid """
+        config = make_config(self.f, self.maskf)
+        grid = model.assoc_grid(config, 'model_temp', preload_data=False)
+        config.set('model_temp', 'imax', '2')
+        self.assertNotEqual(model.grid_key(config, 'model_temp'), 
+                            model.grid_key(config, 'model_sal'))
+        newgrid = model.assoc_grid(config, 'model_temp', preload_data=False)
+        self.assertFalse(newgrid is grid)
+        self.assertTrue(model.assoc_grid(config, 'model_sal', preload_data=False) is grid)
+        self.assertEqual(len(model._grids), 2)
+
+    def test_retain_grids(self):
+        """ Test grids of an earlier ij range are removed """
+        config = make_config(self.f, self.maskf)
+        model.assoc_models(config, preload_data=False)
+        
+        for data_type in ['model_temp', 'model_sal']:
+            config.set(data_type, 'imax', '2')
+            
+        grid = model.assoc_grid(config, 'model_temp', preload_data=False)
+        model.retain_grids(config)
+        self.assertEqual(model._grids.values(), [grid])
+
+
+class TestExtractLevels(unittest.TestCase):
+    """ Unit tests for <model.ModelData.extract_levels> """
+
+    def setUp(self):
+        """ Create model and mask files """
+        np.random.seed(0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.f, self.maskf, self.kbottom = make_files(self.tmpdir)
+        model.clear_grids()
+
+    def tearDown(self):
+        model.clear_grids()
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_columns(self):
+        """ Test levels of lazy model data are found without the full mask """
+        config = make_config(self.f, self.maskf)
+        modelDat = model.assoc_model(config, 'model_temp', read_columns=True)
+        js = np.ma.masked_array([0, 4, 2, 1], mask=[False, False, True, False])
+        iis = np.ma.masked_array([3, 0, 1, 1], mask=[False, False, True, False])
+        nlev = modelDat.extract_levels(js, iis)
+        self.assertTrue(modelDat.grid.kbottom is None)
+        self.assertEqual(list(nlev), [self.kbottom[0, 3], self.kbottom[4, 0], 0, 
+                                      self.kbottom[1, 1]])
+
+    def test_max_depth(self):
+        """ Test levels of lazy model data are limited to the levels used """
+        config = make_config(self.f, self.maskf)
+        modelDat = model.assoc_model(config, 'model_temp', read_columns=True, max_depth=20.)
+        js, iis = np.ma.where(self.kbottom >= 0)
+        nlev = modelDat.extract_levels(np.ma.asarray(js), np.ma.asarray(iis))
+        self.assertEqual(modelDat.levels, slice(0, 4))
+        self.assertTrue((nlev == np.minimum(self.kbottom[js, iis], 4)).all())
+
+
+class TestReadLevels(unittest.TestCase):
+    """ Unit tests for <model.read_requests> and <model.load_models> """
+
+    def setUp(self):
+        """ Create compressed model and mask files on a small grid """
+        np.random.seed(0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.f, self.maskf, self.kbottom = make_files(self.tmpdir)
+        model.clear_grids()
+
+    def tearDown(self):
+        model.clear_grids()
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, read_procs, results):
+        """ Read bottom levels and model data into results """
+        config = make_config(self.f, self.maskf, read_procs=read_procs)
+        grid = model.GridGeometry(config, 'model_temp', preload_data=False)
+        modelDat = model.ModelData(config, 'model_temp', preload_data=False, grid=grid)
+        grid.load_kbottom()
+        results['kbottom'] = grid.kbottom
+        results['data'] = modelDat.read_data()
+
+    def test_procs(self):
+        """ Test reading with two processes matches reading with one """
+        serial, concurrent = {}, {}
+        self.read(1, serial)
+        self.read(2, concurrent)
+        self.assertTrue((concurrent['kbottom'] == self.kbottom).all())
+        self.assertTrue((concurrent['kbottom'] == serial['kbottom']).all())
+        self.assertTrue(np.array_equal(np.isnan(concurrent['data']), np.isnan(serial['data'])))
+        self.assertTrue(np.array_equal(np.nan_to_num(concurrent['data']),
+                                       np.nan_to_num(serial['data'])))
+
+    def test_thread(self):
+        """ Test reading with two processes from a background thread """
+        serial, threaded = {}, {}
+        self.read(1, serial)
+        thread = threading.Thread(target=self.read, args=(2, threaded))
+        thread.start()
+        thread.join()
+        self.assertTrue((threaded['kbottom'] == serial['kbottom']).all())
+        self.assertTrue(np.array_equal(np.nan_to_num(threaded['data']),
+                                       np.nan_to_num(serial['data'])))
+
+    def test_concurrent_reads(self):
+        """ Test worker processes are only used from the main thread """
+        results = []
+        thread = threading.Thread(target=lambda: results.append(model.concurrent_reads()))
+        thread.start()
+        thread.join()
+        self.assertTrue(model.concurrent_reads())
+        self.assertEqual(results, [False])
+
+    def test_variables(self):
+        """ Test temperature and salinity read by one pool match serial reads """
+        serial = model.assoc_models(make_config(self.f, self.maskf))
+        model.clear_grids()
+        concurrent = model.assoc_models(make_config(self.f, self.maskf, read_procs=2))
+        
+        for modelDat, expected in zip(concurrent, serial):
+            self.assertTrue(modelDat.raw is None)
+            self.assertEqual(modelDat.data.dtype, expected.data.dtype)
+            self.assertTrue(np.array_equal(np.isnan(modelDat.data), np.isnan(expected.data)))
+            self.assertTrue(np.array_equal(np.nan_to_num(modelDat.data), 
+                                           np.nan_to_num(expected.data)))
+
+
+if __name__ == '__main__':
+    unittest.main()
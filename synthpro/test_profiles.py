@@ -0,0 +1,103 @@
+"""
+Unit tests for functions in profiles module.
+
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import ConfigParser
+import numpy as np
+from netCDF4 import Dataset
+
+import profiles
+import namelist
+
+
+class TestPackedOutput(unittest.TestCase):
+    """ Unit tests for synthetic profiles packed as 16-bit integers """
+
+    def setUp(self):
+        """ Create observed profiles with valid limits and configuration options """
+        np.random.seed(0)
+        self.tmpdir = tempfile.mkdtemp()
+        obsf = os.path.join(self.tmpdir, 'obs.nc')
+        nprof, nlev = 20, 10
+
+        with Dataset(obsf, 'w') as ncf:
+            ncf.createDimension('N_PROF', nprof)
+            ncf.createDimension('N_LEVELS', nlev)
+            for name in ['LATITUDE', 'LONGITUDE']:
+                ncf.createVariable(name, 'f8', ('N_PROF',), zlib=True,
+                                   fletcher32=True)[:] = np.random.rand(nprof)
+            self.depths = np.ma.masked_array(np.random.rand(nprof, nlev) * 1000, dtype=np.float32)
+            self.depths[:, 8:] = np.ma.masked
+            ncf.createVariable('DEPH_CORRECTED', 'f4', ('N_PROF', 'N_LEVELS'), zlib=True,
+                               fill_value=99999.)[:] = self.depths
+            for name, vmin, vmax in [('POTM_CORRECTED', -5., 40.), ('PSAL_CORRECTED', 0., 45.)]:
+                var = ncf.createVariable(name, 'f4', ('N_PROF', 'N_LEVELS'), zlib=True,
+                                         fill_value=99999.)
+                var.setncatts({'valid_min': np.float32(vmin), 'valid_max': np.float32(vmax)})
+                var[:] = np.ma.masked
+
+        self.config = ConfigParser.ConfigParser()
+        self.config.add_section('obs_profiles')
+        self.config.set('obs_profiles', 'data_type', 'EN4')
+        self.config.set('obs_profiles', 'file_name', obsf)
+        self.config.add_section('synth_profiles')
+        self.config.set('synth_profiles', 'file_name', os.path.join(self.tmpdir, 'synth.nc'))
+
+        for section in ['obs_profiles', 'synth_profiles']:
+            for option, value in [('temp_var', 'POTM_CORRECTED'), ('sal_var', 'PSAL_CORRECTED'),
+                                  ('depth_var', 'DEPH_CORRECTED'), ('lat_var', 'LATITUDE'),
+                                  ('lon_var', 'LONGITUDE')]:
+                self.config.set(section, option, value)
+
+        self.config = namelist.set_defaults(self.config)
+        self.config.set('output', 'pack_data', 'True')
+        self.temps = np.random.rand(nprof, nlev) * 30
+        self.temps[:, 7:] = np.nan
+        self.sals = 30 + np.random.rand(nprof, nlev) * 8
+        self.sals[::2] = np.nan
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """ Test packed temperatures and salinities read back unmasked """
+        profiles.create_synth_file(self.config)
+        synthDat = profiles.SynthProfiles(self.config)
+        synthDat.write_temps(self.temps)
+        synthDat.write_sals(self.sals)
+        readDat = profiles.Profiles(self.config, 'synth_profiles')
+
+        for dat, expected in [(readDat.temps, self.temps), (readDat.sals, self.sals)]:
+            valid = ~np.isnan(expected)
+            self.assertEqual(dat.count(), valid.sum())
+            self.assertTrue((~np.ma.getmaskarray(dat) == valid).all())
+            self.assertTrue(np.allclose(dat[valid], expected[valid], atol=0.001))
+
+    def test_max_obs_depth(self):
+        """ Test deepest observed depth is found from depths read in chunks """
+        for start in [0, 5]:
+            self.assertEqual(profiles.max_obs_depth(self.config, start=start, chunk_size=7),
+                             self.depths[start:].max())
+
+    def test_parallel_output(self):
+        """ Test filters of observed variables are not used with parallel output """
+        self.config.set('parallel', 'submit_parallel', 'True')
+        self.config.set('parallel', 'parallel_output', 'True')
+        profiles.create_synth_file(self.config)
+        profiles.SynthProfiles(self.config)
+
+        with Dataset(self.config.get('synth_profiles', 'file_name')) as ncf:
+            for name, var in ncf.variables.items():
+                filters = var.filters()
+                for opt in ['zlib', 'shuffle', 'fletcher32']:
+                    self.assertFalse(filters[opt], '%s of %s' % (opt, name))
+            for name in ['distance_to_ob', 'i_index', 'j_index']:
+                self.assertTrue(name in ncf.variables)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,6 +28,50 @@ class TestMapCores(unittest.TestCase):
 
         self.assertTrue((dat == 1).all())
 
+class TestBisectCores(unittest.TestCase):
+    """ Unit tests for <tools.bisect_cores> """
+    
+    def setUp(self):
+        """ Create weights concentrated in one corner of the domain """
+        self.weights = np.ones((200, 300))
+        self.weights[150:, 250:] = 50.
+        
+    def test_bisect_complete(self):
+        """ Ensures that all regions are indexed exactly once for any number of cores """
+        for ncores in [1, 3, 5, 8]:
+            dat = np.zeros(self.weights.shape)
+            imins, imaxs, jmins, jmaxs = tools.bisect_cores(self.weights, ncores)
+            self.assertEqual(len(imins), ncores)
+            
+            for ncore in range(ncores):
+                dat[jmins[ncore]:jmaxs[ncore] + 1, imins[ncore]:imaxs[ncore] + 1] += 1
+                
+            self.assertTrue((dat == 1).all())
+            
+    def test_bisect_balanced(self):
+        """ Test that weight is shared approximately equally between cores """
+        ncores = 6
+        imins, imaxs, jmins, jmaxs = tools.bisect_cores(self.weights, ncores)
+        loads = [self.weights[jmins[n]:jmaxs[n] + 1, imins[n]:imaxs[n] + 1].sum() 
+                 for n in range(ncores)]
+        self.assertLess(max(loads) / np.mean(loads), 1.1)
+        
+    def test_bisect_spike(self):
+        """ Test that a weight spike in an edge column does not give tiles one point wide """
+        for col in [0, -1]:
+            weights = np.ones((20, 30))
+            weights[:, col] = 1e6
+            
+            for ncores in [2, 4, 7]:
+                imins, imaxs, jmins, jmaxs = tools.bisect_cores(weights, ncores)
+                self.assertTrue((imaxs > imins).all())
+                self.assertTrue((jmaxs > jmins).all())
+        
+    def test_bisect_too_many(self):
+        """ Test that more cores than 2x2 blocks of grid-points are rejected """
+        self.assertRaises(ValueError, tools.bisect_cores, np.ones((3, 5)), 3)
+        
+        
 class TestIdxIsValid(unittest.TestCase):
     """ Unit tests for <tools.idx_is_valid> """
 
@@ -71,7 +115,7 @@ class TestInterpFullDepth(unittest.TestCase):
         mdl_dat = np.ma.MaskedArray(mdl_z, mask=True)
         interp_z, interp_dat = tools.interp_fulldepth(
             mdl_z, mdl_dat, ob_z)
-        self.assertTrue(all(interp_dat.mask == True))
+        self.assertTrue(np.isnan(interp_dat).all())
         self.assertTrue(len(interp_z) == len(ob_z))
         
     def test_using_valid_data(self):
@@ -97,7 +141,7 @@ class TestInterpObsDepth(unittest.TestCase):
         mdl_dat = np.ma.MaskedArray(mdl_z, mask=True)
         interp_z, interp_dat = tools.interp_obsdepth(
             mdl_z, mdl_dat, ob_z, ob_dat)
-        self.assertTrue(all(interp_dat.mask == True))
+        self.assertTrue(np.isnan(interp_dat).all())
         self.assertTrue(len(interp_z) == len(ob_z))
         
     def test_for_missing_obs(self):
@@ -108,7 +152,7 @@ class TestInterpObsDepth(unittest.TestCase):
         mdl_dat = np.ma.MaskedArray(mdl_z, mask=False)        
         interp_z, interp_dat = tools.interp_obsdepth(
             mdl_z, mdl_dat, ob_z, ob_dat)
-        self.assertTrue(all(interp_dat.mask == True))
+        self.assertTrue(np.isnan(interp_dat).all())
         self.assertTrue(len(interp_z) == len(ob_z))
         
     def test_for_non_overlapping(self):
@@ -119,7 +163,7 @@ class TestInterpObsDepth(unittest.TestCase):
         mdl_dat = np.ma.MaskedArray(mdl_z, mask=mdl_z > 500)        
         interp_z, interp_dat = tools.interp_obsdepth(
             mdl_z, mdl_dat, ob_z, ob_dat)
-        self.assertTrue(all(interp_dat.mask == True))
+        self.assertTrue(np.isnan(interp_dat).all())
         self.assertTrue(len(interp_z) == len(ob_z))
         
     def test_for_masks(self):
@@ -132,8 +176,84 @@ class TestInterpObsDepth(unittest.TestCase):
             mdl_z, mdl_dat, ob_z, ob_dat)
         ind1 = np.where(interp_z < 200)
         ind2 = np.where(interp_z > 700)
-        self.assertTrue(all(interp_dat[ind1].mask == True))
-        self.assertTrue(all(interp_dat[ind2].mask == True))
+        self.assertTrue(np.isnan(interp_dat[ind1]).all())
+        self.assertTrue(np.isnan(interp_dat[ind2]).all())
+        
+        
+class TestInterpObsDepthBatch(unittest.TestCase):
+    """ Unit tests for <tools.interp_obsdepth_batch>"""
+    
+    def setUp(self):
+        """ Create profiles covering each case of <tools.interp_obsdepth> """
+        np.random.seed(0)
+        nobs, nzob = 50, 30
+        self.mdl_z = np.linspace(5, 1000, 40)
+        kbot = np.random.randint(0, 41, nobs)
+        self.mdl_dat = np.ma.MaskedArray(
+            np.random.rand(nobs, 40), mask=np.arange(40) >= kbot[:, np.newaxis])
+        self.ob_z = np.sort(np.random.rand(nobs, nzob) * 1100, axis=1)
+        self.ob_dat = np.ma.MaskedArray(
+            np.random.rand(nobs, nzob), mask=np.random.rand(nobs, nzob) > 0.7)
+        self.ob_dat[0] = np.ma.masked
+        self.mdl_dat[1] = np.ma.masked
+        self.ob_z[2] = np.linspace(0, 1000, nzob)
+        self.ob_dat[2] = np.ma.MaskedArray(self.ob_dat[2], mask=self.ob_z[2] < 500)
+        self.mdl_dat[2] = np.ma.MaskedArray(self.mdl_dat[2], mask=self.mdl_z > 500)
+        self.ob_z[3, 5] = self.mdl_z[10]
+        self.mdl_dat[3] = np.ma.MaskedArray(self.mdl_dat[3], mask=self.mdl_z > self.mdl_z[10])
+        
+    def test_matches_profiles(self):
+        """ Test batch interpolation matches interpolation of each profile """
+        interp_z, interp_dat = tools.interp_obsdepth_batch(
+            self.mdl_z, self.mdl_dat, self.ob_z, self.ob_dat, chunk_size=7)
+        self.assertTrue((interp_z == self.ob_z).all())
+        
+        for n in range(len(self.ob_z)):
+            ob_z, ob_dat = tools.interp_obsdepth(
+                self.mdl_z, self.mdl_dat[n], self.ob_z[n], self.ob_dat[n])
+            mask = np.isnan(ob_dat)
+            self.assertTrue((np.isnan(interp_dat[n]) == mask).all())
+            self.assertTrue(np.allclose(interp_dat[n][~mask], ob_dat[~mask]))
+            
+    def test_missing(self):
+        """ Test profiles with missing or non-overlapping data are masked """
+        interp_z, interp_dat = tools.interp_obsdepth_batch(
+            self.mdl_z, self.mdl_dat, self.ob_z, self.ob_dat)
+        self.assertTrue(np.isnan(interp_dat[0:3]).all())
+        self.assertFalse(np.isnan(interp_dat[3, 5]))
+        self.assertEqual(interp_dat.dtype, self.ob_dat.dtype)
+        
+    def test_levels(self):
+        """ Test interpolation with numbers of valid model levels matches mask """
+        nlev = (~np.ma.getmaskarray(self.mdl_dat)).sum(axis=1)
+        interp_z, interp_dat = tools.interp_obsdepth_batch(
+            self.mdl_z, self.mdl_dat, self.ob_z, self.ob_dat, chunk_size=7)
+        level_z, level_dat = tools.interp_obsdepth_batch(
+            self.mdl_z, self.mdl_dat, self.ob_z, self.ob_dat, chunk_size=7, mdl_nlev=nlev)
+        valid = ~np.isnan(interp_dat)
+        self.assertTrue((np.isnan(level_dat) == ~valid).all())
+        self.assertTrue(np.allclose(level_dat[valid], interp_dat[valid]))
+        
+        
+class TestInterpProfiles(unittest.TestCase):
+    """ Unit tests for <tools.interp_profiles>"""
+    
+    def test_full_depth(self):
+        """ Test full-depth profiles match <tools.interp_fulldepth> """
+        mdl_z = np.arange(15.)
+        mdl_cols = np.ma.MaskedArray(np.tile(mdl_z, (3, 1)), mask=False)
+        mdl_cols[1] = np.ma.masked
+        mdl_cols[2, 10:] = np.ma.masked
+        ob_z = np.ma.MaskedArray(np.tile(np.arange(10.), (3, 1)))
+        syn_z, syn_dat = tools.interp_profiles(mdl_z, mdl_cols, ob_z, ob_z, full_depth=True)
+        
+        for n in range(3):
+            interp_z, interp_dat = tools.interp_fulldepth(mdl_z, mdl_cols[n], ob_z[n])
+            self.assertTrue((syn_z[n] == interp_z).all())
+            self.assertTrue((np.isnan(syn_dat[n]) == np.isnan(interp_dat)).all())
+        
+        self.assertTrue(np.isnan(syn_dat[1]).all())
+        self.assertEqual(syn_dat[2].max(), 9)
         
         
 class TestResampleDepths(unittest.TestCase):
@@ -196,5 +316,227 @@ class TestFindNearest(unittest.TestCase):
         iind, jind, d = tools.find_nearest_neigbour(20, 20, lats, lons)
         self.assertEqual((iind, jind), (None, None))
         
+
+class TestNearestNeighbourIndex(unittest.TestCase):
+    """ Unit tests for <tools.NearestNeighbourIndex> """
+    
+    def setUp(self):
+        lons, lats = np.meshgrid(np.arange(-20, 20, 0.5), np.arange(-10, 10, 0.5))
+        lats[5:10, 5:10] = 1e20
+        lons[5:10, 5:10] = 1e20
+        self.lats, self.lons = lats, lons
+        self.ob_lats = np.array([0.1, -7.4, 9.7, 30., -6.9, 0.])
+        self.ob_lons = np.array([0.2, 5.1, 19.6, 0., -16.9, 21.])
+        
+    def test_matches_scan(self):
+        """ Test batched query against exhaustive search of each location """
+        nn_index = tools.NearestNeighbourIndex(self.lats, self.lons)
+        j, i, dist = nn_index.query(self.ob_lats, self.ob_lons)
+        
+        for n in range(3):
+            d = tools.equirect_distance(self.ob_lats[n], self.ob_lons[n], self.lats, self.lons)
+            self.assertEqual((j[n], i[n]), np.unravel_index(d.argmin(), d.shape))
+            self.assertAlmostEqual(dist[n], d.min()) 
+        
+    def test_rejection(self):
+        """ Test locations > 2 degrees from a valid grid-point are masked """
+        nn_index = tools.NearestNeighbourIndex(self.lats, self.lons)
+        j, i, dist = nn_index.query(self.ob_lats, self.ob_lons)
+        self.assertTrue(j.mask[3] and i.mask[3])
+        self.assertEqual(dist[3], 1.e20)
+        self.assertFalse(j.mask[4])
+        self.assertFalse((self.lats[j[4], i[4]] == 1e20))
+        self.assertFalse(j.mask[5])
+        
+    def test_brute_force(self):
+        """ Test brute-force scan gives same results as tree query """
+        nn_index = tools.NearestNeighbourIndex(self.lats, self.lons, chunk_size=2)
+        j1, i1, d1 = nn_index.query(self.ob_lats, self.ob_lons)
+        nn_index = tools.NearestNeighbourIndex(self.lats, self.lons, chunk_size=2, 
+                                               use_tree=False)
+        self.assertTrue(nn_index.tree is None)
+        j2, i2, d2 = nn_index.query(self.ob_lats, self.ob_lons)
+        self.assertTrue((j1 == j2).all() and (i1 == i2).all())
+        self.assertTrue((d1 == d2).all())
+        
+    def test_dateline(self):
+        """ Test nearest-neighbour search across the dateline """
+        lons, lats = np.meshgrid(np.arange(170, 190, 1.), np.arange(-5, 5, 1.))
+        lons = np.where(lons >= 180, lons - 360, lons)
+        nn_index = tools.NearestNeighbourIndex(lats, lons)
+        j, i, dist = nn_index.query(np.array([0.]), np.array([179.9]))
+        self.assertEqual(lons[j[0], i[0]], -180.)
+        
+class TestOceanColumns(unittest.TestCase):
+    """ Unit tests for <tools.OceanColumns> """
+    
+    def setUp(self):
+        """ Create masked data with a land column and a shallow column """
+        self.data = np.ma.MaskedArray(np.arange(60.).reshape(5, 3, 4), mask=False)
+        self.data[:, 0, 0] = np.ma.masked
+        self.data[2:, 1, 2] = np.ma.masked
+        self.cols = tools.OceanColumns.from_grid(self.data)
+        
+    def test_ocean_only(self):
+        """ Test that land columns are not stored """
+        self.assertEqual(len(self.cols.nlev), 11)
+        self.assertEqual(self.cols.colmap[0, 0], -1)
+        
+    def test_ragged(self):
+        """ Test that levels below the sea floor are not stored """
+        self.assertEqual(len(self.cols.values), 52)
+        self.assertEqual(self.cols.nlev[self.cols.colmap[1, 2]], 2)
+        self.assertEqual(self.cols.levels(np.array([0, 1]), np.array([0, 2])).tolist(), [0, 2])
+        
+    def test_gather(self):
+        """ Test that gathered columns match columns of masked data """
+        js, iis = np.array([1, 0, 2]), np.array([2, 0, 3])
+        cols = self.cols.gather(js, iis)
+        
+        for n in range(len(js)):
+            expected = self.data[:, js[n], iis[n]]
+            self.assertTrue((np.isnan(cols[n]) == expected.mask).all())
+            self.assertTrue(np.ma.allequal(np.ma.masked_invalid(cols[n]), expected))
+            
+    def test_to_grid(self):
+        """ Test that data are unchanged after conversion to and from columns """
+        grid = self.cols.to_grid()
+        self.assertTrue((np.isnan(grid) == self.data.mask).all())
+        self.assertTrue(np.ma.allequal(np.ma.masked_invalid(grid), self.data))
+        
+
+class TestMaskLevels(unittest.TestCase):
+    """ Unit tests for <tools.mask_levels> """
+    
+    def test_grid(self):
+        """ Test levels at or below bottom level are NaN for [z, y, x] data """
+        kbottom = np.array([[0, 2], [5, 3]])
+        dat = tools.mask_levels(np.ones((5, 2, 2)), kbottom)
+        self.assertEqual((~np.isnan(dat)).sum(axis=0).tolist(), kbottom.tolist())
+        self.assertTrue(np.isnan(dat[:, 0, 0]).all())
+        self.assertTrue(np.isnan(dat[2:, 0, 1]).all())
+        
+    def test_columns(self):
+        """ Test existing mask is retained for [n, z] columns """
+        dat = np.ma.MaskedArray(np.ones((2, 4)), mask=False)
+        dat[1, 0] = np.ma.masked
+        dat = tools.mask_levels(dat, np.array([3, 4]), axis=-1)
+        self.assertEqual(np.isnan(dat).tolist(), [[False, False, False, True],
+                                                  [True, False, False, False]])
+        
+
+class TestFillNan(unittest.TestCase):
+    """ Unit tests for <tools.fill_nan> """
+    
+    def test_masked(self):
+        """ Test masked values are returned as NaN in a float array """
+        dat = np.ma.MaskedArray(np.arange(4), mask=[False, True, False, True])
+        filled = tools.fill_nan(dat)
+        self.assertFalse(isinstance(filled, np.ma.MaskedArray))
+        self.assertEqual(filled.dtype, np.float64)
+        self.assertEqual(np.isnan(filled).tolist(), [False, True, False, True])
+        
+    def test_dtype(self):
+        """ Test float data keep their precision unless dtype is given """
+        dat = np.ones(3, dtype=np.float32)
+        self.assertEqual(tools.fill_nan(dat).dtype, np.float32)
+        self.assertEqual(tools.fill_nan(dat, dtype=np.float64).dtype, np.float64)
+        
+
+class TestDataDtype(unittest.TestCase):
+    """ Unit tests for <tools.data_dtype> """
+    
+    def test_precision(self):
+        """ Test float32 is only used when single precision is requested """
+        import ConfigParser
+        config = ConfigParser.ConfigParser()
+        config.add_section('options')
+        config.set('options', 'single_precision', 'False')
+        self.assertTrue(tools.data_dtype(config) is None)
+        config.set('options', 'single_precision', 'True')
+        self.assertEqual(tools.data_dtype(config), np.float32)
+        
+
+class TestDateRange(unittest.TestCase):
+    """ Unit tests for <tools.date_range> """
+    
+    def setUp(self):
+        import argparse
+        import ConfigParser
+        self.args = argparse.Namespace(start_month=11, start_year=2009, end_month=2,
+                                       end_year=2010, namelist='namelist.ini')
+        self.config = ConfigParser.ConfigParser()
+        self.config.add_section('options')
+        
+    def test_monthly(self):
+        """ Test range of months spanning a year boundary """
+        self.config.set('options', 'use_daily_data', 'False')
+        dates = tools.date_range(self.args, self.config)
+        self.assertEqual([(d.year, d.month, d.day) for d in dates], 
+                         [(2009, 11, None), (2009, 12, None), (2010, 1, None), (2010, 2, None)])
+        
+    def test_daily(self):
+        """ Test daily data includes every day of each month """
+        self.config.set('options', 'use_daily_data', 'True')
+        dates = tools.date_range(self.args, self.config)
+        self.assertEqual(len(dates), 30 + 31 + 31 + 28)
+        self.assertEqual((dates[-1].year, dates[-1].month, dates[-1].day), (2010, 2, 28))
+        
+    def test_invalid(self):
+        """ Test end date before start date """
+        self.args.end_year = 2008
+        self.config.set('options', 'use_daily_data', 'False')
+        with self.assertRaises(ValueError):
+            tools.date_range(self.args, self.config)
+            
+
+class TestContiguousRuns(unittest.TestCase):
+    """ Unit tests for <tools.contiguous_runs> """
+    
+    def test_runs(self):
+        """ Test indices are split into contiguous blocks """
+        runs = tools.contiguous_runs(np.array([0, 1, 2, 5, 7, 8]))
+        self.assertEqual(runs, [(0, 3), (5, 6), (7, 9)])
+        
+    def test_empty(self):
+        """ Test empty indices return no blocks """
+        self.assertEqual(tools.contiguous_runs(np.array([], dtype=int)), [])
+        
+
+class TestChunkSlices(unittest.TestCase):
+    """ Unit tests for <tools.chunk_slices> """
+    
+    def test_complete(self):
+        """ Test that chunks cover all rows exactly once """
+        chunks = tools.chunk_slices(10, 4)
+        self.assertEqual(chunks, [slice(0, 4), slice(4, 8), slice(8, 10)])
+        
+    def test_start(self):
+        """ Test that chunks begin at start """
+        chunks = tools.chunk_slices(10, 4, start=6)
+        self.assertEqual(chunks, [slice(6, 10)])
+        
+    def test_empty(self):
+        """ Test that no chunks are returned for an empty range """
+        self.assertEqual(tools.chunk_slices(0, 4), [])
+        
+        
+class TestHashArrays(unittest.TestCase):
+    """ Unit tests for <tools.hash_arrays> """
+    
+    def test_identical(self):
+        """ Test identical arrays return the same key """
+        a = np.arange(10.)
+        self.assertEqual(tools.hash_arrays(a, a * 2), tools.hash_arrays(a.copy(), a * 2))
+        
+    def test_different(self):
+        """ Test changes to values, shape, order and mask change the key """
+        a = np.arange(10.)
+        key = tools.hash_arrays(a, a * 2)
+        self.assertNotEqual(key, tools.hash_arrays(a * 2, a))
+        self.assertNotEqual(key, tools.hash_arrays(a.reshape(2, 5), a * 2))
+        self.assertNotEqual(key, tools.hash_arrays(np.ma.MaskedArray(a, mask=a > 5), a * 2))
+        
+        
 if __name__ == '__main__':
     unittest.main()
@@ -5,7 +5,15 @@ Useful functions
 
 import numpy as np
 import os
-import copy
+import hashlib
+import argparse
+import calendar
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
 
 def rmfile(f):
     """
@@ -22,10 +30,10 @@ def mapcores(ni, nj, nxcores, nycores):
     """
     ncores = nxcores * nycores
     coreshape = (nycores, nxcores)
-    imin = np.zeros(coreshape)
-    imax = np.zeros(coreshape)
-    jmin = np.zeros(coreshape)
-    jmax = np.zeros(coreshape)
+    imin = np.zeros(coreshape, dtype=int)
+    imax = np.zeros(coreshape, dtype=int)
+    jmin = np.zeros(coreshape, dtype=int)
+    jmax = np.zeros(coreshape, dtype=int)
     
     jinds = np.array_split(np.arange(nj), nycores)
     iinds = np.array_split(np.arange(ni), nxcores)
@@ -41,6 +49,107 @@ def mapcores(ni, nj, nxcores, nycores):
             jmin.reshape(ncores), jmax.reshape(ncores))
     
 
+def bisect_cores(weights, ncores):
+    """
+    Return maps of imin, imax, jmin, jmax for each core using recursive
+    bisection of weights with dimensions [y, x]. Each region is split 
+    along its longer axis so that the total weight held by each core 
+    is approximately equal. Each core holds at least two grid-points
+    along each axis.
+    
+    """
+    nj, ni = weights.shape
+    
+    if (ni // 2) * (nj // 2) < ncores:
+        raise ValueError('Number of cores exceeds number of 2x2 blocks of grid-points')
+    
+    tiles = []
+    _bisect(weights, 0, ni - 1, 0, nj - 1, ncores, tiles)
+    tiles = np.array(tiles, dtype=int)
+    
+    if ((tiles[:, 1] <= tiles[:, 0]) | (tiles[:, 3] <= tiles[:, 2])).any():
+        raise ValueError('Cannot bisect %i x %i grid-points between %i cores' % (ni, nj, ncores))
+    
+    return tiles[:, 0], tiles[:, 1], tiles[:, 2], tiles[:, 3]
+
+
+def _bisect(weights, imin, imax, jmin, jmax, ncores, tiles):
+    """ Recursively bisect region and append (imin, imax, jmin, jmax) for each core to tiles """
+    if ncores == 1:
+        tiles.append((imin, imax, jmin, jmax))
+        return
+    
+    ni, nj = imax - imin + 1, jmax - jmin + 1
+    ncores1 = ncores // 2
+    ncores2 = ncores - ncores1
+    split_i = ni >= nj
+    
+    # Split along the shorter axis if the longer one cannot be split between cores
+    cutmin, cutmax = _cut_limits(ni, nj, split_i, ncores1, ncores2)
+    if cutmin > cutmax:
+        split_i = not split_i
+        cutmin, cutmax = _cut_limits(ni, nj, split_i, ncores1, ncores2)
+    
+    region = weights[jmin:jmax + 1, imin:imax + 1]
+    profile = region.sum(axis=0) if split_i else region.sum(axis=1)
+    
+    if profile.sum() <= 0:
+        profile = np.ones(len(profile))
+    
+    # Choose cut closest to the target share of the weight 
+    cumulative = np.cumsum(profile)
+    target = cumulative[-1] * ncores1 / float(ncores)
+    cut = np.searchsorted(cumulative, target)
+    if (cut > 0) and (abs(cumulative[cut - 1] - target) <= abs(cumulative[cut] - target)):
+        cut -= 1
+    
+    cut = int(np.clip(cut, cutmin, cutmax))
+    
+    if split_i:
+        _bisect(weights, imin, imin + cut, jmin, jmax, ncores1, tiles)
+        _bisect(weights, imin + cut + 1, imax, jmin, jmax, ncores2, tiles)
+    else:
+        _bisect(weights, imin, imax, jmin, jmin + cut, ncores1, tiles)
+        _bisect(weights, imin, imax, jmin + cut + 1, jmax, ncores2, tiles)
+
+
+def _cut_limits(ni, nj, split_i, ncores1, ncores2):
+    """ 
+    Return range of cuts of region with ni x nj grid-points that leave 
+    each side at least two grid-points along each axis for its cores
+    
+    """
+    length, width = (ni, nj) if split_i else (nj, ni)
+    pairs = max(width // 2, 1)
+    
+    return 2 * -(-ncores1 // pairs) - 1, length - 1 - 2 * -(-ncores2 // pairs)
+
+
+def contiguous_runs(inds):
+    """ 
+    Return list of (start, stop) slices covering sorted 
+    integer indices in contiguous blocks.
+    
+    """
+    inds = np.asarray(inds)
+    
+    if len(inds) == 0:
+        return []
+    
+    breaks = np.where(np.diff(inds) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(inds)]])
+    
+    return [(inds[start], inds[stop - 1] + 1) for start, stop in zip(starts, stops)]
+
+
+def chunk_slices(nmax, chunk_size, start=0):
+    """ Return list of slices splitting range(start, nmax) into chunks of chunk_size """
+    chunk_size = max(int(chunk_size), 1)
+    
+    return [slice(n0, min(n0 + chunk_size, nmax)) for n0 in range(start, nmax, chunk_size)]
+
+
 def idx_is_valid(ind):
     """ Return False if index returned by <np.where> is empty. """
     
@@ -56,16 +165,19 @@ def interp_1d(xnew, x, y):
 def interp_fulldepth(mdl_z, mdl_dat, ob_z):
     """
     Return  data over full model depth range interpolated to have
-    the same number of zlevels as the observed profile.
+    the same number of zlevels as the observed profile. Missing 
+    values are returned as NaN.
     
     """
-    if all(mdl_dat.mask == True):
-        interp_dat = np.ma.MaskedArray(ob_z, mask=True)
+    mdl_dat = fill_nan(mdl_dat)
+    zind = ~np.isnan(mdl_dat)
+    
+    if not zind.any():
+        interp_dat = np.ones(len(ob_z), dtype=mdl_dat.dtype) * np.nan
         interp_z = ob_z
     else:
-        zind = np.where(mdl_dat.mask != True)
         interp_z = resample_depths(mdl_z[zind], len(ob_z))
-        interp_dat = interp_1d(interp_z, mdl_z, mdl_dat)
+        interp_dat = interp_1d(interp_z, mdl_z[zind], mdl_dat[zind])
     
     return interp_z, interp_dat
 
@@ -74,38 +186,130 @@ def interp_obsdepth(mdl_z, mdl_dat, ob_z, ob_dat):
     """
     Return model data interpolated to observed depths. Depths
     that are unobserved or outside the valid model range are
-    masked and returned as missing values.
+    returned as NaN.
 
     """
-    interp_z = ob_z
-    interp_dat = copy.deepcopy(ob_dat)
-    
-    if all(ob_dat.mask == True):    # Case 1
-        interp_dat = copy.deepcopy(ob_dat)
-    elif all(mdl_dat.mask == True): # Case 2
-        interp_dat = np.ma.MaskedArray(copy.deepcopy(ob_dat), mask=True)
-    else:
+    interp_z = fill_nan(ob_z, dtype=np.float64)
+    ob_dat = fill_nan(ob_dat)
+    mdl_dat = fill_nan(mdl_dat)
+    interp_dat = np.ones(ob_dat.shape, dtype=ob_dat.dtype) * np.nan
+    maskind_mdl = ~np.isnan(mdl_dat)
+    maskind_ob = ~np.isnan(ob_dat)
+    
+    if maskind_ob.any() and maskind_mdl.any(): # Cases 1 and 2 are missing
         # Find min/max depths after dealing with mdi values
-        maskind_mdl = np.where(mdl_dat.mask != True)
-        maskind_ob = np.where(ob_dat.mask != True)
         mdl_minz, mdl_maxz = mdl_z[maskind_mdl].min(), mdl_z[maskind_mdl].max()
-        ob_minz, ob_maxz = ob_z[maskind_ob].min(), ob_z[maskind_ob].max()        
+        ob_minz, ob_maxz = interp_z[maskind_ob].min(), interp_z[maskind_ob].max()        
         
         # Find depth indices and ensure obs are between valid model depths 
-        zind_mdl = np.where((mdl_z >= mdl_minz) & (mdl_z <= mdl_maxz))
-        zind_ob = np.where((ob_z >= ob_minz) & (ob_z <= ob_maxz) 
-                           & (ob_z <= mdl_maxz) & (ob_z >= mdl_minz))
+        zind_mdl = (mdl_z >= mdl_minz) & (mdl_z <= mdl_maxz)
+        with np.errstate(invalid='ignore'):
+            zind_ob = ((interp_z >= ob_minz) & (interp_z <= ob_maxz) 
+                       & (interp_z <= mdl_maxz) & (interp_z >= mdl_minz))
         
-        if idx_is_valid(zind_ob) and idx_is_valid(zind_mdl):
-            interp_dat = np.ma.MaskedArray(copy.deepcopy(ob_dat), mask=True)
+        if zind_ob.any() and zind_mdl.any():
             interp_dat[zind_ob] = interp_1d(
-                ob_z[zind_ob], mdl_z[zind_mdl], mdl_dat[zind_mdl])
-        else:
-            interp_dat = np.ma.MaskedArray(copy.deepcopy(ob_dat), mask=True)
+                interp_z[zind_ob], mdl_z[zind_mdl], mdl_dat[zind_mdl])
         
     return interp_z, interp_dat
 
 
+def interp_obsdepth_batch(mdl_z, mdl_dat, ob_z, ob_dat, chunk_size=4096, mdl_nlev=None):
+    """
+    Return model data interpolated to observed depths for many profiles. 
+    Equivalent to <interp_obsdepth> applied to each profile, where mdl_dat 
+    has dimensions [n, nz_model] and ob_z and ob_dat have dimensions 
+    [n, nz_obs]. Profiles are processed in chunks of chunk_size. If given,
+    mdl_nlev holds the number of valid model levels in each profile and
+    replaces the search for missing model values. Missing values are 
+    NaN in the inputs and in the returned data.
+
+    """
+    mdl_z = np.asarray(mdl_z, dtype=np.float64)
+    mdl_dat = fill_nan(mdl_dat)
+    ob_z = fill_nan(ob_z, dtype=np.float64)
+    ob_dat = fill_nan(ob_dat)
+    interp_dat = np.ones(ob_dat.shape, dtype=ob_dat.dtype) * np.nan
+    
+    for n0 in range(0, ob_dat.shape[0], chunk_size):
+        chunk = slice(n0, n0 + chunk_size)
+        nlev = None if mdl_nlev is None else mdl_nlev[chunk]
+        vals, valid = _interp_obsdepth_chunk(
+            mdl_z, mdl_dat[chunk], ob_z[chunk], ob_dat[chunk], mdl_nlev=nlev)
+        interp_dat[chunk][valid] = vals[valid]
+    
+    return ob_z, interp_dat
+
+
+def _interp_obsdepth_chunk(mdl_z, mdl_dat, ob_z, ob_dat, mdl_nlev=None):
+    """ 
+    Return interpolated values and valid points for a chunk of 
+    profiles processed by <interp_obsdepth_batch>.
+    
+    """
+    nzm = len(mdl_z)
+    rows = np.arange(mdl_dat.shape[0])[:, np.newaxis]
+    ob_valid = ~np.isnan(ob_dat)
+    z = ob_z
+    dat = mdl_dat.astype(np.float64)
+    
+    # Find min/max depths after dealing with mdi values (cases 1 and 2)
+    if mdl_nlev is None:
+        mdl_valid = ~np.isnan(mdl_dat)
+        mdl_minz = np.where(mdl_valid, mdl_z, np.inf).min(axis=1)[:, np.newaxis]
+        mdl_maxz = np.where(mdl_valid, mdl_z, -np.inf).max(axis=1)[:, np.newaxis]
+    else:
+        nlev = np.asarray(mdl_nlev)[:, np.newaxis]
+        mdl_minz = np.where(nlev > 0, mdl_z[0], np.inf)
+        mdl_maxz = np.where(nlev > 0, mdl_z[np.maximum(nlev - 1, 0)], -np.inf)
+    ob_minz = np.where(ob_valid, z, np.inf).min(axis=1)[:, np.newaxis]
+    ob_maxz = np.where(ob_valid, z, -np.inf).max(axis=1)[:, np.newaxis]
+    
+    # Ensure obs are between valid model depths
+    with np.errstate(invalid='ignore'):
+        valid = ((z >= ob_minz) & (z <= ob_maxz) & 
+                 (z >= mdl_minz) & (z <= mdl_maxz))
+        
+    # Find bracketing model levels within the valid model depth range
+    k0 = np.searchsorted(mdl_z, mdl_minz, side='left')
+    k1 = np.searchsorted(mdl_z, mdl_maxz, side='right') - 1
+    kb = np.searchsorted(mdl_z, np.where(valid, z, mdl_z[0]), side='right') - 1
+    kb = np.clip(kb, k0, np.maximum(k1 - 1, k0))
+    kb = np.clip(kb, 0, nzm - 1)
+    kt = np.minimum(kb + 1, np.clip(k1, 0, nzm - 1))
+    
+    # Linear interpolation between bracketing levels
+    dz = mdl_z[kt] - mdl_z[kb]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wt = np.where(dz > 0, (z - mdl_z[kb]) / dz, 0.)
+    vals = dat[rows, kb] + wt * (dat[rows, kt] - dat[rows, kb])
+    
+    return vals, valid
+
+
+def interp_profiles(mdl_z, mdl_cols, ob_z, ob_dat, full_depth=False, mdl_nlev=None):
+    """
+    Return synthetic depths and data with dimensions [n, nz_obs] from 
+    model profiles with dimensions [n, nz_model]. Model data are either
+    interpolated to observed depths or, if full_depth is True, resampled 
+    over the full model depth range. mdl_nlev optionally gives the number 
+    of valid levels in each model profile. Missing values are returned 
+    as NaN.
+    
+    """
+    if not full_depth:
+        return interp_obsdepth_batch(mdl_z, mdl_cols, ob_z, ob_dat, mdl_nlev=mdl_nlev)
+    
+    mdl_cols = fill_nan(mdl_cols)
+    syn_depths = fill_nan(ob_z, dtype=np.float64).copy()
+    syn_dat = np.ones(ob_dat.shape, dtype=mdl_cols.dtype) * np.nan
+    
+    for nob in range(len(mdl_cols)):
+        syn_depths[nob], syn_dat[nob] = interp_fulldepth(mdl_z, mdl_cols[nob], syn_depths[nob])
+        
+    return syn_depths, syn_dat
+
+
 def resample_depths(z, nz):
     """
     Resample depths while maintaining variable resolution
@@ -135,32 +339,222 @@ def resample_depths(z, nz):
     return znew
 
 
-def find_nearest_neigbour(obs_lat, obs_lon, model_lats, model_lons):
-    """ Return coordinate for nearest-neighbor model grid-point """ 
+def find_nearest_neigbour(obs_lat, obs_lon, model_lats, model_lons, max_tol=2.):
+    """ 
+    Return coordinate for nearest-neighbor model grid-point. A single
+    location is searched by a brute-force scan, which is cheaper than 
+    building a spatial index that is only queried once.
     
-    tol = 0.25
-    max_tol = 2
-    init_idx = ([], [])
+    """ 
+    nn_index = NearestNeighbourIndex(model_lats, model_lons, use_tree=False)
+    j, i, dist = nn_index.query(np.array([obs_lat]), np.array([obs_lon]), max_tol=max_tol)
     
-    while (len(init_idx[0]) == 0) & (tol < max_tol):
-        init_idx = np.where((model_lats <= obs_lat + tol) & 
-                            (model_lats >= obs_lat - tol) & 
-                            (model_lons <= obs_lon + tol) & 
-                            (model_lons >= obs_lon - tol))
-        tol = tol * 2.
+    if j.mask[0]:
+        return None, None, 1.e20
     
-    if tol < max_tol:
-        init_lats = model_lats[init_idx]
-        init_lons = model_lons[init_idx]
+    return j[0], i[0], dist[0]
+
+
+def latlon_to_xyz(lats, lons):
+    """ Return cartesian coordinates on the unit sphere with dimensions [n, 3] """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    coslat = np.cos(lats)
+    
+    return np.column_stack((coslat * np.cos(lons), coslat * np.sin(lons), np.sin(lats)))
+
+
+def wrap_lon_diff(dlon):
+    """ Return longitude differences wrapped onto the range [-180, 180) """
+    
+    return (dlon + 180.) % 360. - 180.
+
+
+class NearestNeighbourIndex(object):
+    """
+    Spatial index of valid model grid-points used to find the
+    nearest-neighbour model grid-point for many observed locations
+    in a single query. Grid-points are indexed using cartesian
+    coordinates on the unit sphere so that chord distances rank
+    grid-points in the same order as great circle distances.
+    
+    """
+    def __init__(self, model_lats, model_lons, fill_value=1e20, chunk_size=1024, 
+                 use_tree=True):
+        """ 
+        Build index from 2D model latitudes and longitudes. A kd-tree
+        is only built if scipy is available and use_tree is True.
+        Otherwise, queries use a brute-force scan.
         
-        d = equirect_distance(obs_lat, obs_lon, init_lats, init_lons)    
-        final_idx = np.unravel_index(d.argmin(), d.shape)
-        j, i  = init_idx[0][final_idx], init_idx[1][final_idx]
-        dist= d.min()
-    else:
-        j, i, dist = None, None, 1.e20
+        """
+        valid = (model_lats != fill_value) & (model_lons != fill_value)
+        self.jinds, self.iinds = np.where(valid)
+        self.lats = model_lats[valid]
+        self.lons = model_lons[valid]
+        self.npoints = len(self.jinds)
+        self.chunk_size = chunk_size
+        self.xyz = latlon_to_xyz(self.lats, self.lons)
         
-    return j, i, dist
+        if use_tree and (cKDTree is not None) and (self.npoints > 0):
+            self.tree = cKDTree(self.xyz)
+        else:
+            self.tree = None
+            
+    def _query_brute_force(self, xyz, k):
+        """ Return indices of k nearest grid-points using a chunked brute-force scan """
+        nearest = np.zeros((len(xyz), k), dtype=np.int64)
+        
+        for n0 in range(0, len(xyz), self.chunk_size):
+            chunk = xyz[n0:n0 + self.chunk_size]
+            d2 = ((chunk[:, np.newaxis, :] - self.xyz[np.newaxis, :, :])**2).sum(axis=2)
+            
+            if k < self.npoints:
+                d2_ind = np.argpartition(d2, k, axis=1)[:, :k]
+            else:
+                d2_ind = np.argsort(d2, axis=1)[:, :k]
+            nearest[n0:n0 + self.chunk_size] = d2_ind
+            
+        return nearest
+        
+    def query(self, obs_lats, obs_lons, max_tol=2., ncandidates=4):
+        """
+        Return j, i indices of the nearest-neighbour model grid-point
+        and the distance to each observed location. Observations without
+        a valid grid-point within max_tol degrees latitude/longitude are
+        returned with masked j, i indices and distance = 1.e20.
+        
+        The closest ncandidates grid-points on the unit sphere are ranked
+        using <equirect_distance> so that the chosen grid-point is consistent
+        with the distance returned.
+        
+        """
+        obs_lats = np.ma.filled(np.ma.asarray(obs_lats, dtype=np.float64), np.nan)
+        obs_lons = np.ma.filled(np.ma.asarray(obs_lons, dtype=np.float64), np.nan)
+        nobs = len(obs_lats)
+        j = np.zeros(nobs, dtype=np.int64)
+        i = np.zeros(nobs, dtype=np.int64)
+        dist = np.ones(nobs) * 1.e20
+        found = np.isfinite(obs_lats) & np.isfinite(obs_lons)
+        
+        if self.npoints == 0:
+            found[:] = False
+        
+        if found.any():
+            ob_lats = obs_lats[found][:, np.newaxis]
+            ob_lons = obs_lons[found][:, np.newaxis]
+            xyz = latlon_to_xyz(ob_lats[:, 0], ob_lons[:, 0])
+            k = min(ncandidates, self.npoints)
+            
+            if self.tree is not None:
+                candidates = self.tree.query(xyz, k=k)[1].reshape(len(xyz), k)
+            else:
+                candidates = self._query_brute_force(xyz, k)
+            
+            cand_lats = self.lats[candidates]
+            cand_lons = ob_lons + wrap_lon_diff(self.lons[candidates] - ob_lons)
+            cand_dist = equirect_distance(ob_lats, ob_lons, cand_lats, cand_lons)
+            best = cand_dist.argmin(axis=1)
+            rows = np.arange(len(best))
+            nearest = candidates[rows, best]
+            near_dist = cand_dist[rows, best]
+            in_range = ((np.abs(cand_lats[rows, best] - ob_lats[:, 0]) <= max_tol) &
+                        (np.abs(cand_lons[rows, best] - ob_lons[:, 0]) <= max_tol))
+            j[found] = self.jinds[nearest]
+            i[found] = self.iinds[nearest]
+            dist[found] = np.where(in_range, near_dist, 1.e20)
+            found[found] = in_range
+
+        j = np.ma.MaskedArray(j, mask=~found)
+        i = np.ma.MaskedArray(i, mask=~found)
+        
+        return j, i, dist
+        
+
+class OceanColumns(object):
+    """
+    Class holding ocean columns of a model variable as ragged columns 
+    that are truncated at the sea floor. Values for all columns are held 
+    in a single array, where the nlev values of each column are contiguous 
+    in memory, together with the j, i index and number of levels of each 
+    column and a map from j, i to column. Land columns are not stored.
+
+    """
+    def __init__(self, values, jinds, iinds, nlev, shape, nz):
+        """ 
+        Initialize <OceanColumns> for model grid with dimensions 
+        shape=[y, x] and nz levels.
+        
+        """
+        self.values = values
+        self.jinds = jinds
+        self.iinds = iinds
+        self.nlev = nlev
+        self.nz = nz
+        self.offsets = np.concatenate([[0], np.cumsum(nlev)]).astype(np.int64)
+        self.colmap = -np.ones(shape, dtype=np.int64)
+        self.colmap[jinds, iinds] = np.arange(len(jinds))
+        
+    @classmethod
+    def from_levels(cls, data, kbottom, dtype=None):
+        """ 
+        Return <OceanColumns> holding data with dimensions [z, y, x] 
+        above the bottom levels kbottom with dimensions [y, x]. 
+        
+        """
+        nz = data.shape[0]
+        jinds, iinds = np.where(kbottom > 0)
+        nlev = np.asarray(kbottom[jinds, iinds], dtype=np.int64)
+        columns = fill_nan(data[:, jinds, iinds].T, dtype=dtype)
+        values = columns[np.arange(nz) < nlev[:, np.newaxis]]
+        
+        return cls(values, jinds, iinds, nlev, data.shape[1:], nz)
+    
+    @classmethod
+    def from_grid(cls, data, dtype=None):
+        """ 
+        Return <OceanColumns> holding data with dimensions [z, y, x]
+        down to the deepest level of each column that is neither masked 
+        nor NaN.
+        
+        """
+        valid = ~np.isnan(fill_nan(data))
+        kbottom = np.where(valid.any(axis=0), len(data) - valid[::-1].argmax(axis=0), 0)
+        
+        return cls.from_levels(data, kbottom, dtype=dtype)
+    
+    def levels(self, js, iis):
+        """ Return number of stored levels for local j, i indices """
+        idx = self.colmap[js, iis]
+        
+        return np.where(idx >= 0, self.nlev[np.maximum(idx, 0)], 0)
+
+    def gather(self, js, iis):
+        """
+        Return model profiles with dimensions [n, z] for local j, i
+        indices. Values are read in storage order and land points and 
+        levels below the sea floor are returned as NaN.
+
+        """
+        idx = self.colmap[js, iis]
+        valid = np.arange(self.nz) < self.levels(js, iis)[:, np.newaxis]
+        pos = (self.offsets[np.maximum(idx, 0)][:, np.newaxis] + np.arange(self.nz))[valid]
+        order = np.argsort(pos, kind='mergesort')
+        vals = np.empty(len(pos), dtype=self.values.dtype)
+        vals[order] = self.values[pos[order]]
+        dat = np.ones((len(idx), self.nz), dtype=self.values.dtype) * np.nan
+        dat[valid] = vals
+
+        return dat
+
+    def to_grid(self):
+        """ Return columns as <np.array> with dimensions [z, y, x] and NaN over land """
+        valid = np.arange(self.nz) < self.nlev[:, np.newaxis]
+        cols = np.ones((len(self.nlev), self.nz), dtype=self.values.dtype) * np.nan
+        cols[valid] = self.values
+        dat = np.ones((self.nz,) + self.colmap.shape, dtype=self.values.dtype) * np.nan
+        dat[:, self.jinds, self.iinds] = cols.T
+
+        return dat
 
 
 def equirect_distance(lat1, lon1, lat2, lon2):
@@ -178,6 +572,69 @@ def equirect_distance(lat1, lon1, lat2, lon2):
     return d
         
 
+def hash_arrays(*arrays):
+    """ Return hex digest identifying the shape and contents of arrays """
+    digest = hashlib.sha1()
+    
+    for arr in arrays:
+        dat = np.ascontiguousarray(np.ma.getdata(arr))
+        digest.update(repr((dat.shape, dat.dtype.str)))
+        digest.update(dat.tostring())
+        
+        if np.ma.is_masked(arr):
+            digest.update(np.ascontiguousarray(np.ma.getmaskarray(arr)).tostring())
+    
+    return digest.hexdigest()
+
+
+def fill_nan(dat, dtype=None):
+    """ 
+    Return data as floating point <np.array> with masked values set to 
+    NaN. Data are converted to dtype if given or to float64 if they are 
+    not floating point. Unmasked data may be returned without a copy.
+    
+    """
+    dat = np.ma.asarray(dat)
+    
+    if dtype is None:
+        dtype = dat.dtype if dat.dtype.kind == 'f' else np.float64
+    
+    if dat.dtype != dtype:
+        dat = dat.astype(dtype)
+    
+    if dat.mask is np.ma.nomask:
+        return dat.data
+    
+    return dat.filled(np.nan)
+
+
+def data_dtype(config):
+    """ 
+    Return dtype used to hold model and profile data or None if data 
+    are held in the precision of their netcdf files.
+    
+    """
+    if config.getboolean('options', 'single_precision'):
+        return np.float32
+    
+    return None
+
+
+def mask_levels(dat, kbottom, axis=0):
+    """ 
+    Return data as floating point <np.array> with levels at or below 
+    kbottom and masked values set to NaN. Levels lie along axis and 
+    kbottom has the dimensions of the remaining axes. Unmasked floating 
+    point data are modified in place.
+    
+    """
+    dat = fill_nan(dat)
+    below = np.arange(dat.shape[axis]) >= np.asarray(kbottom)[..., np.newaxis]
+    dat[np.rollaxis(below, -1, axis % dat.ndim)] = np.nan
+    
+    return dat
+
+
 def mask_data(dat, mask, mask_mdi, fill_value=None):
     """ Return data as np.ma.MaskedArray with applied mask. """
     
@@ -222,6 +679,37 @@ def insert_date(args, config, f):
     return f
     
 
+def date_range(args, config):
+    """ 
+    Return list of arguments for each month (or day if using daily data)
+    between start_month/start_year and end_month/end_year inclusive.
+    
+    """
+    start = args.start_year * 12 + args.start_month - 1
+    end = args.end_year * 12 + args.end_month - 1
+    
+    if end < start:
+        raise ValueError('End date %02i/%4i is before start date %02i/%4i' % 
+                         (args.end_month, args.end_year, args.start_month, args.start_year))
+    
+    dates = []
+    
+    for nmonth in range(start, end + 1):
+        year, month = nmonth // 12, nmonth % 12 + 1
+        
+        if config.getboolean('options', 'use_daily_data'):
+            days = range(1, calendar.monthrange(year, month)[1] + 1)
+        else:
+            days = [None]
+            
+        for day in days:
+            dates.append(argparse.Namespace(
+                year=year, month=month, day=day, namelist=args.namelist,
+                resume=getattr(args, 'resume', False)))
+    
+    return dates
+    
+
 def build_file_name(args, config, section):
     """
     Create name of file containing profile data